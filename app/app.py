@@ -1,14 +1,14 @@
 from __future__ import annotations
 
+import logging
+import os
 from pathlib import Path
 
 import streamlit as st
-import torch
 from dotenv import load_dotenv
-
-# TODO: find a better way? It is only a warning but disturbs me
-# https://github.com/VikParuchuri/marker/issues/442
-torch.classes.__path__ = []  # add this line to manually set it to empty.
+from pages.utils import startup
+from pages.utils.metrics import start_metrics_server
+from pages.utils.model_registry import get_model_registry
 
 SCRIPT_PATH = Path(__file__).parent.absolute()
 results = load_dotenv()
@@ -17,6 +17,11 @@ if not results:
 
 
 def main():
+    startup.mark("app script")
+    start_metrics_server()
+    if not os.environ.get("NOSTALGIA_INFERENCE_URL"):
+        # Every search needs CLIP, load it while the first page renders
+        get_model_registry().preload(["clip"])
     search_page = st.Page("pages/search_data.py", title="Search Engine", icon="🔍")
     upload_page = st.Page(
         "pages/upload_data.py",
@@ -26,7 +31,9 @@ def main():
     pg = st.navigation([search_page, upload_page])
     st.set_page_config(page_icon="🔍", page_title="Image Search Engine", layout="wide")
     pg.run()
+    startup.mark(f"{pg.title} page rendered")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     main()
@@ -0,0 +1,105 @@
+"""
+Compare plain and assisted (draft model) decoding of the Gemma captions.
+
+A sample of indexed photos is captioned twice, once by the target model alone
+and once with the draft model proposing the tokens. Both runs use the same
+greedy settings and skip the prompt prefix cache, so the only difference is
+the decoding. The script reports the tokens/s of each mode and how many
+captions are identical. Run it from `app`:
+
+    python -m benchmarks.assisted_captioning --sample 20 --draft google/gemma-3-1b-it
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import time
+
+from pages.utils.blob_store import BlobStore
+from pages.utils.elastic import get_client
+from pages.utils.image_models import generate_image_description
+from pages.utils.image_models import load_gemma_draft_model
+from pages.utils.image_models import load_gemma_model
+from PIL import Image
+
+
+def fetch_sample(es_client, index_name, size):
+    response = es_client.search(
+        index=index_name,
+        size=size,
+        query={"exists": {"field": "image_ref"}},
+        source=["image_ref"],
+    )
+    return [hit["_source"]["image_ref"] for hit in response["hits"]["hits"]]
+
+
+def caption_all(images, model, processor, language, assistant):
+    captions, seconds = [], []
+    for image in images:
+        start = time.perf_counter()
+        captions.append(
+            generate_image_description(
+                image,
+                model,
+                processor,
+                language=language,
+                use_prefix_cache=False,
+                assistant=assistant,
+            ),
+        )
+        seconds.append(time.perf_counter() - start)
+    return captions, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--index", default="images")
+    parser.add_argument("--sample", type=int, default=20)
+    parser.add_argument("--language", default="spanish")
+    parser.add_argument("--draft", default="google/gemma-3-1b-it")
+    args = parser.parse_args()
+
+    store = BlobStore()
+    refs = fetch_sample(get_client(), args.index, args.sample)
+    images = [
+        Image.open(store.thumbnail_path(ref, 1024)).convert("RGB") for ref in refs
+    ]
+    model, processor = load_gemma_model()
+    assistant = load_gemma_draft_model(args.draft)
+
+    # Warm up both paths so the first measured image doesn't pay for it
+    caption_all(images[:1], model, processor, args.language, False)
+    caption_all(images[:1], model, processor, args.language, assistant)
+    print(f"{len(images)} images, draft {args.draft}")
+    print(f"{'mode':>10}{'tokens/s':>10}{'median s':>10}{'speedup':>9}")
+
+    results = {}
+    for mode, mode_assistant in [("plain", False), ("assisted", assistant)]:
+        captions, seconds = caption_all(
+            images,
+            model,
+            processor,
+            args.language,
+            mode_assistant,
+        )
+        tokens = sum(
+            len(processor.tokenizer(caption, add_special_tokens=False)["input_ids"])
+            for caption in captions
+        )
+        results[mode] = (captions, sum(seconds))
+        print(
+            f"{mode:>10}{tokens / sum(seconds):>10.1f}{statistics.median(seconds):>10.2f}"
+            f"{results['plain'][1] / sum(seconds):>8.2f}x",
+        )
+
+    plain, assisted = results["plain"][0], results["assisted"][0]
+    equal = sum(a == b for a, b in zip(plain, assisted))
+    print(f"Identical captions: {equal}/{len(plain)}")
+    for ref, a, b in zip(refs, plain, assisted):
+        if a != b:
+            print(f"\n{ref}\n  plain:    {a}\n  assisted: {b}")
+
+
+if __name__ == "__main__":
+    main()
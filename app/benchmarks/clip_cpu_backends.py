@@ -0,0 +1,132 @@
+"""
+Compare the CPU backends of the CLIP encoders.
+
+A sample of indexed photos (with their stored image vectors and caption
+embeddings) is re-encoded with every backend. The script reports the
+single-query latency of each backend, its speedup over eager fp32 and the
+cosine similarity of its vectors with the ones stored in the index. Run it
+from `app` on a CPU-only host:
+
+    python -m benchmarks.clip_cpu_backends --sample 50 --threads 4
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+import torch
+from pages.utils.blob_store import BlobStore
+from pages.utils.elastic import get_client
+from pages.utils.image_models import CLIP_BACKENDS
+from pages.utils.image_models import encode_images
+from pages.utils.image_models import encode_texts
+from pages.utils.image_models import load_clip_model
+from PIL import Image
+
+
+def fetch_sample(es_client, index_name, size):
+    response = es_client.search(
+        index=index_name,
+        size=size,
+        query={
+            "bool": {
+                "filter": [
+                    {"exists": {"field": "image_ref"}},
+                    {"exists": {"field": "generated_description"}},
+                ],
+            },
+        },
+        source=[
+            "image_ref",
+            "image_vector",
+            "generated_description",
+            "generated_description_embedding",
+        ],
+    )
+    return [hit["_source"] for hit in response["hits"]["hits"]]
+
+
+def cosine(a, b):
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    a = a / np.linalg.norm(a, axis=-1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=-1, keepdims=True)
+    return (a * b).sum(axis=-1)
+
+
+def time_per_item(fn, items, repeats):
+    timings = []
+    for _ in range(repeats):
+        for item in items:
+            start = time.perf_counter()
+            fn(item)
+            timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def measure_backend(backend, images, texts, stored_images, stored_texts, repeats):
+    # The model is released on return, before the next backend is loaded
+    model, preprocess = load_clip_model(backend=backend)
+
+    def encode_image(image):
+        return encode_images([image], model, preprocess, num_workers=1)
+
+    def encode_text(text):
+        return encode_texts([text], model)
+
+    image_ms = time_per_item(encode_image, images, repeats)
+    text_ms = time_per_item(encode_text, texts, repeats)
+    image_cos = cosine(encode_images(images, model, preprocess), stored_images)
+    text_cos = cosine(encode_texts(texts, model), stored_texts)
+    return image_ms, text_ms, image_cos, text_cos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--index", default="images")
+    parser.add_argument("--sample", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--backends", nargs="+", default=list(CLIP_BACKENDS))
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    store = BlobStore()
+    documents = fetch_sample(get_client(), args.index, args.sample)
+    images = [
+        Image.open(store.path(doc["image_ref"])).convert("RGB") for doc in documents
+    ]
+    texts = [doc["generated_description"] for doc in documents]
+    stored_images = [doc["image_vector"] for doc in documents]
+    stored_texts = [doc["generated_description_embedding"] for doc in documents]
+    print(f"{len(documents)} documents, {torch.get_num_threads()} threads")
+    print(
+        f"{'backend':>12}{'image ms':>10}{'text ms':>10}{'speedup':>9}"
+        f"{'image cos':>11}{'min':>7}{'text cos':>10}{'min':>7}",
+    )
+
+    baseline = None
+    for backend in args.backends:
+        image_ms, text_ms, image_cos, text_cos = measure_backend(
+            backend,
+            images,
+            texts,
+            stored_images,
+            stored_texts,
+            args.repeats,
+        )
+        total = image_ms + text_ms
+        baseline = baseline or total
+        print(
+            f"{backend:>12}{image_ms:>10.1f}{text_ms:>10.1f}{baseline / total:>8.2f}x"
+            f"{image_cos.mean():>11.4f}{image_cos.min():>7.3f}"
+            f"{text_cos.mean():>10.4f}{text_cos.min():>7.3f}",
+        )
+
+
+if __name__ == "__main__":
+    main()
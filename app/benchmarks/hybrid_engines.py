@@ -0,0 +1,87 @@
+"""
+Compare client-side fusion with the server-side `rrf` and `linear` retrievers.
+
+For every text query the script reports the median latency of each engine and
+the overlap of its top-k ids with the client-side ranking. Run from `app`:
+
+    python -m benchmarks.hybrid_engines "perro en la playa" "cena con amigos"
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import time
+
+from pages.utils.elastic import get_client
+from pages.utils.elastic import search_data
+from pages.utils.elastic import SEARCH_ENGINES
+from pages.utils.image_models import encode_texts
+from pages.utils.image_models import load_clip_model
+
+
+def overlap_at_k(reference, candidate, k):
+    reference_ids = [hit["_id"] for hit in reference[:k]]
+    candidate_ids = {hit["_id"] for hit in candidate[:k]}
+    if not reference_ids:
+        return 1.0
+    return sum(doc_id in candidate_ids for doc_id in reference_ids) / len(reference_ids)
+
+
+def time_engine(es_client, index_name, engine, text_query, text_vector, top_n, repeats):
+    timings = []
+    hits = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        hits = search_data(
+            es_client,
+            index_name,
+            text_query=text_query,
+            text_vector=text_vector,
+            top_n=top_n,
+            engine=engine,
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("queries", nargs="+")
+    parser.add_argument("--index", default="images")
+    parser.add_argument("--top-n", type=int, default=100)
+    parser.add_argument("--k", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    es_client = get_client()
+    clip_model, _ = load_clip_model()
+    vectors = encode_texts(args.queries, clip_model)
+
+    for text_query, text_vector in zip(args.queries, vectors):
+        print(f"\nQuery: {text_query!r}")
+        print(
+            f"{'engine':>8}{'median ms':>12}"
+            + "".join(f"{'overlap@' + str(k):>13}" for k in args.k),
+        )
+        reference = None
+        for engine in SEARCH_ENGINES:
+            median, hits = time_engine(
+                es_client,
+                args.index,
+                engine,
+                text_query,
+                text_vector,
+                args.top_n,
+                args.repeats,
+            )
+            if reference is None:
+                reference = hits
+            overlaps = "".join(
+                f"{overlap_at_k(reference, hits, k):>13.2f}" for k in args.k
+            )
+            print(f"{engine:>8}{median:>12.1f}{overlaps}")
+
+
+if __name__ == "__main__":
+    main()
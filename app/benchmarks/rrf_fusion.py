@@ -0,0 +1,110 @@
+"""
+Compare the latency of the reciprocal rank fusion modes.
+
+Run from the `app` directory against a populated index:
+
+    python -m benchmarks.rrf_fusion --sizes 1 3 7 14 --repeats 20
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import statistics
+import time
+
+import numpy as np
+from pages.utils.elastic import FUSION_MODES
+from pages.utils.elastic import generate_filters
+from pages.utils.elastic import generate_knn_search
+from pages.utils.elastic import get_client
+from pages.utils.elastic import reciprocal_rank_fusion
+
+WORDS = ["playa", "montaña", "ciudad", "noche", "comida", "perro", "río", "nieve"]
+
+
+def random_queries(n_queries, top_n, dims=512, seed=0):
+    """Build `n_queries` sub-queries mixing kNN searches and BM25 matches."""
+    rng = np.random.default_rng(seed)
+    picker = random.Random(seed)
+    filter_dict = generate_filters(None)
+    queries: list[dict] = []
+    while len(queries) < n_queries:
+        if len(queries) % 4 == 3:
+            queries.append(
+                {
+                    "query": {
+                        "multi_match": {
+                            "query": " ".join(picker.sample(WORDS, 2)),
+                            "fields": ["title", "description", "generated_description"],
+                        },
+                    },
+                },
+            )
+        else:
+            vector = rng.normal(size=dims)
+            vector /= np.linalg.norm(vector)
+            queries += generate_knn_search(
+                vector.astype(np.float32),
+                5,
+                top_n,
+                filter_dict,
+            )
+    return queries[:n_queries]
+
+
+def time_mode(es_client, index_name, queries, mode, top_n, repeats):
+    timings = []
+    results = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        results = reciprocal_rank_fusion(
+            es_client,
+            index_name,
+            queries,
+            top_n=top_n,
+            mode=mode,
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--index", default="images")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1, 3, 7, 14])
+    parser.add_argument("--modes", nargs="+", default=list(FUSION_MODES))
+    parser.add_argument("--top-n", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    es_client = get_client()
+    header = f"{'queries':>8}" + "".join(f"{mode + ' ms':>14}" for mode in args.modes)
+    print(header + f"{'speedup':>10}")
+    for size in args.sizes:
+        queries = random_queries(size, args.top_n)
+        medians = {}
+        reference = None
+        for mode in args.modes:
+            medians[mode], results = time_mode(
+                es_client,
+                args.index,
+                queries,
+                mode,
+                args.top_n,
+                args.repeats,
+            )
+            ranking = [(hit["_id"], hit["_rrf_score"]) for hit in results]
+            if reference is None:
+                reference = ranking
+            elif ranking != reference:
+                print(
+                    f"WARNING: {mode} returned a different ranking for {size} queries",
+                )
+        speedup = medians[args.modes[0]] / min(medians.values())
+        row = f"{size:>8}" + "".join(f"{medians[mode]:>14.1f}" for mode in args.modes)
+        print(row + f"{speedup:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
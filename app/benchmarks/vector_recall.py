@@ -0,0 +1,194 @@
+"""
+Recall and latency of the quantized vector index options against the float mapping.
+
+The `image_vector` of a random sample of indexed photos is used as the query
+vectors. The index is copied once per index type into `<index>-recall-<type>`
+and merged to a single segment, then every kNN search is compared with the
+exact cosine ranking of all the photos (the query photo itself excluded).
+With `--window` each type is measured again with the exact rescoring pass of
+the search page over that many candidates. Next to it the script prints the
+vector bytes each type keeps in memory per photo (the three vector fields)
+and the size of the index on disk. Run from `app`:
+
+    python -m benchmarks.vector_recall --types hnsw int8_hnsw bbq_hnsw --k 10 50 --window 200
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import time
+
+from pages.utils.elastic import create_index
+from pages.utils.elastic import delete_index
+from pages.utils.elastic import generate_exact_knn_search
+from pages.utils.elastic import get_client
+from pages.utils.elastic import rescore_exact
+from pages.utils.elastic import run_queries_msearch
+from pages.utils.elastic import VECTOR_FIELDS
+from pages.utils.elastic import VECTOR_INDEX_TYPES
+from pages.utils.serializers import unpack_vector
+
+FIELD = "image_vector"
+DIMS = 512
+# Bytes per vector kept in memory by HNSW, the float vectors stay on disk for rescoring
+VECTOR_BYTES = {
+    "hnsw": 4 * DIMS,
+    "int8_hnsw": DIMS + 4,
+    "int4_hnsw": DIMS // 2 + 4,
+    "bbq_hnsw": DIMS // 8 + 14,
+}
+
+
+def fetch_queries(es_client, index_name, size, seed):
+    response = es_client.search(
+        index=index_name,
+        size=size,
+        query={
+            "function_score": {
+                "query": {"exists": {"field": FIELD}},
+                "random_score": {"seed": seed, "field": "_seq_no"},
+            },
+        },
+        source=[FIELD],
+    )
+    return [
+        (hit["_id"], unpack_vector(hit["_source"][FIELD]))
+        for hit in response["hits"]["hits"]
+    ]
+
+
+def copy_index(es_client, source, target, index_type):
+    delete_index(es_client, target)
+    create_index(es_client, target, vector_index_type=index_type)
+    start = time.perf_counter()
+    es_client.options(request_timeout=3600).reindex(
+        source={"index": source},
+        dest={"index": target},
+        wait_for_completion=True,
+        refresh=True,
+    )
+    es_client.options(request_timeout=3600).indices.forcemerge(
+        index=target,
+        max_num_segments=1,
+    )
+    es_client.indices.refresh(index=target)
+    return time.perf_counter() - start
+
+
+def knn_query(vector, exclude_id, k, num_candidates):
+    return {
+        "knn": {
+            "field": FIELD,
+            "query_vector": vector,
+            "k": k,
+            "num_candidates": max(k, num_candidates),
+            "filter": {"bool": {"must_not": {"ids": {"values": [exclude_id]}}}},
+        },
+    }
+
+
+def exact_ids(es_client, index_name, vector, exclude_id, k):
+    query = generate_exact_knn_search(knn_query(vector, exclude_id, k, k), [])
+    # Rank every photo instead of a candidate list
+    query["query"]["script_score"]["query"] = {
+        "bool": {
+            "filter": {"exists": {"field": FIELD}},
+            "must_not": {"ids": {"values": [exclude_id]}},
+        },
+    }
+    hits = run_queries_msearch(es_client, index_name, [query], source=False)[0]
+    return [hit["_id"] for hit in hits]
+
+
+def knn_ids(es_client, index_name, vector, exclude_id, k, num_candidates, window):
+    query = knn_query(vector, exclude_id, max(k, window), num_candidates)
+    hits_per_query = run_queries_msearch(es_client, index_name, [query], source=False)
+    if window:
+        hits_per_query = rescore_exact(
+            es_client,
+            index_name,
+            [query],
+            hits_per_query,
+            window,
+            source=False,
+        )
+    return [hit["_id"] for hit in hits_per_query[0]]
+
+
+def recall_at_k(expected, found, k):
+    expected = expected[:k]
+    if not expected:
+        return 1.0
+    return len(set(expected) & set(found[:k])) / len(expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--index", default="images")
+    parser.add_argument(
+        "--types",
+        nargs="+",
+        choices=VECTOR_INDEX_TYPES,
+        default=list(VECTOR_INDEX_TYPES),
+    )
+    parser.add_argument("--sample", type=int, default=50)
+    parser.add_argument("--k", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--num-candidates", type=int, default=100)
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=0,
+        help="Also measure exact rescoring of this many candidates.",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep", action="store_true", help="Keep the copied indices.")
+    args = parser.parse_args()
+
+    es_client = get_client()
+    queries = fetch_queries(es_client, args.index, args.sample, args.seed)
+    max_k = max(args.k)
+    expected = [
+        exact_ids(es_client, args.index, vector, id, max_k) for id, vector in queries
+    ]
+    print(f"{len(queries)} query photos, num_candidates {args.num_candidates}")
+    print(
+        f"{'type':>10}{'window':>8}{'median ms':>11}"
+        + "".join(f"{'recall@' + str(k):>11}" for k in args.k)
+        + f"{'vector B/photo':>16}{'disk B/photo':>14}",
+    )
+
+    for index_type in args.types:
+        target = f"{args.index}-recall-{index_type}"
+        copy_index(es_client, args.index, target, index_type)
+        stats = es_client.indices.stats(index=target, metric=["store", "docs"])["_all"][
+            "primaries"
+        ]
+        disk = stats["store"]["size_in_bytes"] / max(stats["docs"]["count"], 1)
+        for window in sorted({0, args.window}):
+            timings, recalls = [], {k: [] for k in args.k}
+            for (id, vector), reference in zip(queries, expected):
+                start = time.perf_counter()
+                found = knn_ids(
+                    es_client,
+                    target,
+                    vector,
+                    id,
+                    max_k,
+                    args.num_candidates,
+                    window,
+                )
+                timings.append((time.perf_counter() - start) * 1000)
+                for k in args.k:
+                    recalls[k].append(recall_at_k(reference, found, k))
+            print(
+                f"{index_type:>10}{window:>8}{statistics.median(timings):>11.1f}"
+                + "".join(f"{statistics.mean(recalls[k]):>11.3f}" for k in args.k)
+                + f"{VECTOR_BYTES[index_type] * len(VECTOR_FIELDS):>16}{disk:>14.0f}",
+            )
+        if not args.keep:
+            delete_index(es_client, target)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,57 @@
 from __future__ import annotations
 
-import base64
 import logging
-from io import BytesIO
+import os
 
 import streamlit as st
 from elasticsearch import Elasticsearch
+from pages.utils.blob_store import BlobStore
+from pages.utils.blob_store import hash_bytes
 from pages.utils.elastic import get_client
 from pages.utils.elastic import get_facets
-from pages.utils.elastic import search_data
-from pages.utils.image_models import generate_image_vector
-from pages.utils.image_models import generate_text_vector
-from pages.utils.image_models import load_clip_model
+from pages.utils.elastic import hydrate_hits
+from pages.utils.elastic import SEARCH_ENGINES
+from pages.utils.elastic import search_with_facets
+from pages.utils.embedding_cache import image_cache_key
+from pages.utils.facet_cache import get_facet_cache
+from pages.utils.image_models import encode_images
+from pages.utils.image_models import encode_texts
+from pages.utils.image_models import get_clip_cache_id
+from pages.utils.inference_client import get_inference_client
+from pages.utils.metrics import summary as metrics_summary
+from pages.utils.model_registry import get_model_registry
+from pages.utils.query_cache import QueryEmbeddingCache
 from PIL import Image
 
 
 LOGGER = logging.getLogger(__file__)
+PAGE_SIZES = [10, 20, 50]
+FACET_FIELDS = ["city", "country"]
+
+
+@st.cache_resource
+def cache_get_query_cache():
+    return QueryEmbeddingCache()
+
+
+def query_text_vector(text_query):
+    def compute():
+        if INFERENCE_CLIENT:
+            return INFERENCE_CLIENT.encode_texts([text_query])[0]
+        with MODEL_REGISTRY.use("clip") as (clip_model, _):
+            return encode_texts([text_query], clip_model)[0]
+
+    return QUERY_CACHE.text_vector(get_clip_cache_id(), text_query, compute)
+
+
+def query_image_vector(image, image_hash):
+    def compute():
+        if INFERENCE_CLIENT:
+            return INFERENCE_CLIENT.encode_images([image])[0]
+        with MODEL_REGISTRY.use("clip") as (clip_model, clip_processor):
+            return encode_images([image], clip_model, clip_processor)[0]
+
+    return QUERY_CACHE.image_vector(get_clip_cache_id(), image_hash, compute)
 
 
 def search_engine(
@@ -24,6 +60,9 @@ def search_engine(
     text_query=None,
     text_vector=None,
     filters=None,
+    engine="client",
+    rescore_window=0,
+    facet_fields=None,
 ):
     """
     Function for the search engine that handles all search types
@@ -31,43 +70,53 @@ def search_engine(
             image_file: The uploaded image file (optional)
             text_query: The text query string (optional)
             filters: Dictionary containing filter parameters
+            engine: Where results are fused (client, rrf or linear)
+            rescore_window: Fused candidates re-ranked with exact cosine similarity
+            facet_fields: Fields to count among the results in the same request
 
     Returns:
-            List of search results
+            List of search results and their facets (None without facet_fields)
     """
-    return search_data(
+    return search_with_facets(
         es_client,
         "images",
         text_query=text_query,
         text_vector=text_vector,
         image_vector=image_vector,
         filters=filters,
+        engine=engine,
+        ids_only=True,
+        rescore_window=rescore_window,
+        facet_fields=facet_fields,
     )
 
 
-def fetch_facets(filters, fields=["city", "country"], size: int = 20):
-    return get_facets(get_client(), "images", fields, filters, size=size)
+def fetch_facets(filters, fields=FACET_FIELDS, size: int = 20):
+    return get_facets(ES_CLIENT, "images", fields, filters, size=size)
 
 
-def display_results(results):
+def display_results(results, total=None):
     if not results:
         st.info("No results found.")
         return
 
-    st.subheader(f"Found {len(results)} results")
+    st.subheader(f"Found {total if total is not None else len(results)} results")
     for i, result in enumerate(results):
         document = result["_source"]
         with st.container():
             image_col, text_col = st.columns([1, 9], vertical_alignment="center")
 
             with image_col:
-                res_bites = BytesIO(base64.b64decode(document["base64"]))
-                res_im = Image.open(res_bites)
-                st.image(
-                    res_im,
-                    caption=document["title"],
-                    use_container_width=True,
-                )
+                if document.get("image_ref"):
+                    st.image(
+                        str(BLOB_STORE.thumbnail_path(document["image_ref"], 256)),
+                        caption=document.get("title"),
+                        use_container_width=True,
+                    )
+                else:
+                    st.warning(
+                        f"{document.get('title')}: image not migrated to the blob store yet",
+                    )
 
             with text_col:
                 rrf_score_col, es_score_col, _ = st.columns([1, 1, 1])
@@ -79,19 +128,44 @@ def display_results(results):
                 else:
                     rrf_score_col.write(f"Similarity: {result['_score']}")
                 st.markdown(
-                    f"**Generated Description**: {document['generated_description']}",
+                    f"**Generated Description**: {document.get('generated_description')}",
                 )
-                st.write(f"**Description**: {document['description']}")
-                st.write(f"**Tags**: {', '.join(document['tags'] or [])}")
-                st.write(f"**Date**: {document['date']}")
+                st.write(f"**Description**: {document.get('description')}")
+                st.write(f"**Tags**: {', '.join(document.get('tags') or [])}")
+                st.write(f"**Date**: {document.get('date')}")
                 cols = st.columns(3)
-                cols[0].write(f"**City**: {document['city']}")
-                cols[1].write(f"**Country**: {document['country']}")
+                cols[0].write(f"**City**: {document.get('city')}")
+                cols[1].write(f"**Country**: {document.get('country')}")
 
             st.divider()
 
 
+def display_page(es_client: Elasticsearch, results):
+    """Hydrate and render only the current page of an ids-only result list."""
+    if not results:
+        display_results(results)
+        return
+    size_col, page_col, _ = st.columns([1, 1, 4])
+    page_size = size_col.selectbox("Results per page", PAGE_SIZES, key="page_size")
+    n_pages = (len(results) + page_size - 1) // page_size
+    if st.session_state.get("page", 1) > n_pages:
+        st.session_state["page"] = n_pages
+    page = page_col.number_input(
+        f"Page (of {n_pages})",
+        min_value=1,
+        max_value=n_pages,
+        key="page",
+    )
+    start = (page - 1) * page_size
+    page_hits = hydrate_hits(es_client, "images", results[start : start + page_size])
+    display_results(page_hits, total=len(results))
+
+
 ES_CLIENT = get_client()
+BLOB_STORE = BlobStore()
+QUERY_CACHE = cache_get_query_cache()
+INFERENCE_CLIENT = get_inference_client()
+MODEL_REGISTRY = get_model_registry()
 st.title("Image Search Engine")
 st.write("Search for images using image files, text queries, or both")
 
@@ -111,6 +185,10 @@ for env in st_zero_keys:
 
 if "filters" not in st.session_state:
     st.session_state["filters"] = {}
+if "results" not in st.session_state:
+    st.session_state["results"] = None
+if "result_facets" not in st.session_state:
+    st.session_state["result_facets"] = None
 
 image = None
 if uploaded_file is not None:
@@ -128,8 +206,38 @@ st.subheader("Text Search")
 text_query = st.text_input("Enter search text (optional)", label_visibility="collapsed")
 
 # Sidebar for filtering options
+st.sidebar.header("Search Options")
+engine = st.sidebar.selectbox(
+    "Fusion engine",
+    SEARCH_ENGINES,
+    help="client fuses the sub-queries here, rrf/linear fuse them inside Elasticsearch",
+)
+rescore_window = st.sidebar.number_input(
+    "Exact rescoring window",
+    min_value=0,
+    max_value=1000,
+    value=int(os.environ.get("NOSTALGIA_RESCORE_WINDOW", 0)),
+    step=50,
+    help="Re-rank the vector matches among this many fused candidates with exact cosine "
+    "similarity (client engine only, 0 to disable)",
+)
+result_facets = st.sidebar.checkbox(
+    "Facet counts from the results",
+    help="Count cities and countries among the search results, read from the hits "
+    "themselves, instead of over the whole collection",
+)
+
 st.sidebar.header("Filter Options")
 
+with st.sidebar.expander("Query embedding cache"):
+    st.json(QUERY_CACHE.stats())
+with st.sidebar.expander("Facet cache"):
+    st.json(get_facet_cache().stats())
+with st.sidebar.expander("Resident models"):
+    st.json(MODEL_REGISTRY.stats())
+with st.sidebar.expander("Stage timings"):
+    st.json(metrics_summary())
+
 # Date filter
 st.sidebar.subheader("Date Filter")
 use_date_filter = st.sidebar.checkbox("Filter by date")
@@ -140,23 +248,56 @@ if use_date_filter:
     start_date = col1.date_input("Start date")
     end_date = col2.date_input("End date")
 
-facets = fetch_facets(st.session_state["filters"])
+# Search button
+if st.button("Search"):
+    with st.spinner("Searching..."):
+        # Call the placeholder function with whatever inputs are available
+        # Generate vectors, repeated queries are served from the cache
+        image_vector = text_vector = None
+        if text_query:
+            text_vector = query_text_vector(text_query)
+        if image:
+            image_hash = image_cache_key(
+                hash_bytes(uploaded_file.getvalue()),
+                st.session_state["image_rotation"] or 0,
+            )
+            image_vector = query_image_vector(image, image_hash)
+        results, facets = search_engine(
+            ES_CLIENT,
+            image_vector=image_vector,
+            text_query=text_query,
+            text_vector=text_vector,
+            # A click reruns the page without changing the filters, those of the
+            # last run are current and the sidebar can show the new counts below
+            filters=st.session_state["filters"],
+            engine=engine,
+            rescore_window=rescore_window,
+            facet_fields=FACET_FIELDS if result_facets else None,
+        )
+        st.session_state["results"] = results
+        st.session_state["result_facets"] = facets
+        st.session_state["page"] = 1
+
+if result_facets and st.session_state["result_facets"] is not None:
+    facets = st.session_state["result_facets"]
+else:
+    facets = fetch_facets(st.session_state["filters"])
 cities, countries = facets["city"], facets["country"]
 
 st.sidebar.subheader("City Filter")
 use_city_filter = st.sidebar.checkbox("Filter by city")
 selected_cities = []
 if use_city_filter:
-    for city in cities:
-        if st.sidebar.checkbox(city, key=f"city_{city}_facet"):
+    for city, count in cities.items():
+        if st.sidebar.checkbox(f"{city} ({count})", key=f"city_{city}_facet"):
             selected_cities.append(city)
 
 st.sidebar.subheader("Country Filter")
 use_country_filter = st.sidebar.checkbox("Filter by country")
 selected_countries = []
 if use_country_filter:
-    for country in countries:
-        if st.sidebar.checkbox(country, key=f"country_{country}_facet"):
+    for country, count in countries.items():
+        if st.sidebar.checkbox(f"{country} ({count})", key=f"country_{country}_facet"):
             selected_countries.append(country)
 
 # Collect all filters
@@ -176,29 +317,5 @@ filters = {
 }
 st.session_state["filters"] = filters
 
-# Search button
-if st.button("Search"):
-    with st.spinner("Searching..."):
-        # Call the placeholder function with whatever inputs are available
-        # Load clip and generate vectors
-        clip_model, clip_processor = load_clip_model()
-        image_vector = text_vector = None
-        if text_query:
-            text_vector = (
-                generate_text_vector([text_query], clip_model).cpu().tolist()[0]
-            )
-        if image:
-            image_vector = (
-                generate_image_vector(image, clip_model, clip_processor)
-                .reshape(-1)
-                .cpu()
-                .tolist()
-            )
-        results = search_engine(
-            ES_CLIENT,
-            image_vector=image_vector,
-            text_query=text_query,
-            text_vector=text_vector,
-            filters=filters,
-        )
-        display_results(results)
+if st.session_state["results"] is not None:
+    display_page(ES_CLIENT, st.session_state["results"])
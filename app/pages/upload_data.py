@@ -1,47 +1,140 @@
 from __future__ import annotations
 
-import base64
 import datetime
 import hashlib
+import logging
+import os
 import re
-from io import BytesIO
+import threading
 
 import streamlit as st
 from pages.utils import journal
+from pages.utils.blob_store import BlobStore
+from pages.utils.blob_store import rotated_blob_id
+from pages.utils.caption_worker import CaptionWorker
 from pages.utils.elastic import create_index
 from pages.utils.elastic import delete_index
 from pages.utils.elastic import get_client
 from pages.utils.elastic import index_data
-from pages.utils.image_exif import get_exif_ifd
-from pages.utils.image_exif import get_geo
+from pages.utils.embedding_cache import EmbeddingCache
+from pages.utils.embedding_cache import image_cache_key
+from pages.utils.embedding_cache import text_cache_key
 from pages.utils.image_exif import get_location_name
+from pages.utils.image_models import encode_images
+from pages.utils.image_models import encode_texts
+from pages.utils.image_models import GEMMA_MODEL_ID
 from pages.utils.image_models import generate_image_description
-from pages.utils.image_models import generate_image_vector
-from pages.utils.image_models import generate_text_vector
-from pages.utils.image_models import load_clip_model
-from pages.utils.image_models import load_gemma_model
+from pages.utils.image_models import get_clip_cache_id
+from pages.utils.image_models import stream_image_description
+from pages.utils.inference_client import get_inference_client
+from pages.utils.metadata import read_header_metadata
+from pages.utils.model_registry import get_model_registry
 from PIL import Image
 from pillow_heif import register_heif_opener
 
 register_heif_opener()
 
+LOGGER = logging.getLogger(__file__)
+
 
 @st.cache_resource
-def cache_load_gemma_model(model_id=None):
-    model, processor = load_gemma_model(model_id)
-    st.session_state["model"] = True
-    st.session_state["processor"] = True
-    return model, processor
+def cache_generate_image_description(_image, _model, _processor):
+    return generate_image_description(_image, _model, _processor)
 
 
 @st.cache_resource
-def cache_load_clip_model():
-    return load_clip_model()
+def cache_get_embedding_cache():
+    return EmbeddingCache()
 
 
 @st.cache_resource
-def cache_generate_image_description(_image, _model, _processor):
-    return generate_image_description(_image, _model, _processor)
+def cache_start_caption_worker():
+    """One background captioning worker per server process."""
+    return CaptionWorker(
+        get_client(),
+        "images",
+        blob_store=BlobStore(),
+        embedding_cache=cache_get_embedding_cache(),
+        inference_client=get_inference_client(),
+    ).start()
+
+
+def cached_image_vector(image, image_key):
+    def compute(_):
+        if INFERENCE_CLIENT:
+            return INFERENCE_CLIENT.encode_images([image])
+        with MODEL_REGISTRY.use("clip") as (clip_model, clip_processor):
+            return encode_images([image], clip_model, clip_processor)
+
+    return EMBEDDING_CACHE.get_or_compute_vectors(
+        [image_key],
+        get_clip_cache_id(),
+        "image_vector",
+        compute,
+    )[0]
+
+
+def cached_text_vectors(texts):
+    def compute(missing):
+        if INFERENCE_CLIENT:
+            return INFERENCE_CLIENT.encode_texts([texts[i] for i in missing])
+        with MODEL_REGISTRY.use("clip") as (clip_model, _):
+            return encode_texts([texts[i] for i in missing], clip_model)
+
+    return EMBEDDING_CACHE.get_or_compute_vectors(
+        [text_cache_key(text) for text in texts],
+        get_clip_cache_id(),
+        "text_vector",
+        compute,
+    )
+
+
+def cached_image_description(image, image_key, language="spanish"):
+    kind = f"caption:{language}"
+    description = EMBEDDING_CACHE.get_text(image_key, GEMMA_MODEL_ID, kind)
+    if description is None:
+        if INFERENCE_CLIENT:
+            description = INFERENCE_CLIENT.caption(image, language)
+        else:
+            with MODEL_REGISTRY.use("gemma") as (model, processor):
+                description = cache_generate_image_description(image, model, processor)
+        EMBEDDING_CACHE.put_text(image_key, GEMMA_MODEL_ID, kind, description)
+    return description
+
+
+def streamed_image_description(image, image_key, language="spanish"):
+    """
+    Like `cached_image_description`, but the caption is rendered while it is generated.
+
+    If the script is stopped midway (the user interacts with the page or leaves
+    it) the generation is cancelled and nothing is cached, neither is an empty
+    caption. A failed generation raises.
+    """
+    kind = f"caption:{language}"
+    description = EMBEDDING_CACHE.get_text(image_key, GEMMA_MODEL_ID, kind)
+    if description is not None:
+        return description
+    if INFERENCE_CLIENT:
+        return cached_image_description(image, image_key, language)
+    cancel_event = threading.Event()
+    placeholder = st.empty()
+    try:
+        with MODEL_REGISTRY.use("gemma") as (model, processor), placeholder.container():
+            description = st.write_stream(
+                stream_image_description(
+                    image,
+                    model,
+                    processor,
+                    language=language,
+                    cancel_event=cancel_event,
+                ),
+            )
+    finally:
+        cancel_event.set()
+    placeholder.empty()
+    if description:
+        EMBEDDING_CACHE.put_text(image_key, GEMMA_MODEL_ID, kind, description)
+    return description
 
 
 @st.cache_resource
@@ -50,18 +143,9 @@ def cache_get_location_name(_gps_info):
 
 
 @st.cache_resource
-def cache_get_exif_data(_image):
-    try:
-        exif_data = _image.getexif()
-        gps_info = get_geo(exif_data)
-        exif_info = get_exif_ifd(exif_data)
-        date = exif_info["DateTimeOriginal"]
-        if date:
-            date_obj = datetime.datetime.strptime(date, "%Y:%m:%d %H:%M:%S")
-            date = date_obj.strftime("%Y-%m-%dT%H:%M:%SZ")
-        return date, gps_info
-    except Exception:
-        return None, None
+def cache_get_exif_data(_file):
+    # Only the header is parsed, the image doesn't need to be decoded first
+    return read_header_metadata(_file)
 
 
 def validate_datetime_from_input(input):
@@ -97,10 +181,7 @@ def upload_data(
 
 def clear_fields():
     for key in st.session_state.keys():
-        if (
-            key not in ["model", "processor", "uploaded_file", "filename"]
-            and "uploaded" not in key
-        ):
+        if key not in ["uploaded_file", "filename"] and "uploaded" not in key:
             st.session_state[key] = None
 
 
@@ -111,11 +192,8 @@ def submit_action():
     st.session_state["uploaded_file"] += 1
 
 
-model = processor = None
 st_env_keys = [
     "submitted",
-    "model",
-    "processor",
     "filename",
     "generated_text_query",
     "title",
@@ -141,17 +219,33 @@ if st.session_state["submitted"]:
     st.session_state["submitted"] = False
 
 ES_CLIENT = get_client()
+BLOB_STORE = BlobStore()
+EMBEDDING_CACHE = cache_get_embedding_cache()
+INFERENCE_CLIENT = get_inference_client()
+MODEL_REGISTRY = get_model_registry()
+CAPTION_WORKER = (
+    cache_start_caption_worker()
+    if os.environ.get("NOSTALGIA_CAPTION_WORKER", "1") == "1"
+    else None
+)
 st.title("Image Database")
 page_desc, load_model_col, ping_es, create_index_es, delete_index_es = st.columns(5)
 with page_desc:
     st.write("Upload new images to the index.")
-    if not (st.session_state.model and st.session_state.processor):
+    if INFERENCE_CLIENT:
+        st.success("The models are served by the inference server!")
+    elif not MODEL_REGISTRY.is_loaded("gemma"):
         st.warning("The description model is not loaded yet!")
     else:
         st.success("The model is loaded!")
+    if CAPTION_WORKER:
+        st.caption(
+            "Photos uploaded without a description are captioned in the background "
+            f"({CAPTION_WORKER.captioned} so far).",
+        )
 with load_model_col:
     if st.button("Load Model", use_container_width=True):
-        model, processor = cache_load_gemma_model()
+        MODEL_REGISTRY.get("gemma")
         st.text("Model loaded Successfully!")
 with ping_es:
     if st.button("Ping Engine", use_container_width=True):
@@ -206,7 +300,7 @@ with preview_col:
                 st.rerun()
 if uploaded_file is not None:
     try:
-        image_date, image_gps_info = cache_get_exif_data(image)
+        image_date, image_gps_info = cache_get_exif_data(uploaded_file)
     except TypeError:
         image_date = image_gps_info = None
     title_col, city_col, country_col, date_col = st.columns(4)
@@ -239,15 +333,24 @@ if uploaded_file is not None:
     st.subheader("Auto-generated Description (optional)")
     gen_button, gen_text = st.columns([1, 5])
     with gen_button:
-        if st.button("Generate", use_container_width=True):
-            model, processor = cache_load_gemma_model()
-            llm_description = cache_generate_image_description(image, model, processor)
+        generate = st.button("Generate", use_container_width=True)
+    with gen_text:
+        if generate:
+            image_key = image_cache_key(
+                generate_file_id(uploaded_file),
+                st.session_state["image_rotation"] or 0,
+            )
+            try:
+                llm_description = streamed_image_description(image, image_key)
+            except Exception:
+                LOGGER.exception("Unable to generate the description")
+                st.error("Unable to generate the description, please try again.")
+                llm_description = None
             if (
                 st.session_state["generated_text_query"] is None
                 and st.session_state["generated_text_query"] != llm_description
             ):
                 st.session_state["generated_text_query"] = llm_description
-    with gen_text:
         generated_text_query = st.text_input(
             "Edit generated description (optional)",
             key="generated_text_query",
@@ -285,39 +388,39 @@ if st.button("Upload"):
         )
     elif uploaded_file:
         with st.spinner("Uploading..."):
-            # Load clip and generate vectors
-            clip_model, clip_processor = cache_load_clip_model()
-            texts = [generated_text_query]
-            if text_query:
-                texts.append(text_query)
-            texts_vectors = generate_text_vector(texts, clip_model)
-            image_vector = generate_image_vector(image, clip_model, clip_processor)
+            # Generate vectors, clip is only loaded for the ones not cached yet
+            file_id = generate_file_id(uploaded_file)
+            rotation = st.session_state["image_rotation"] or 0
+            # Without a generated description the background worker captions it later
+            generated_text_query = generated_text_query or None
+            texts = [text for text in [generated_text_query, text_query] if text]
+            texts_vectors = cached_text_vectors(texts) if texts else []
+            generated_vector = texts_vectors[0] if generated_text_query else None
+            description_vector = texts_vectors[-1] if text_query else None
+            image_vector = cached_image_vector(
+                image,
+                image_cache_key(file_id, rotation),
+            )
             # Call the placeholder function with whatever inputs are available
-            buffered = BytesIO()
-            image.save(buffered, format="JPEG")
-            img_str = base64.b64encode(buffered.getvalue())
+            image_ref = BLOB_STORE.put(rotated_blob_id(file_id, rotation), image)
             results = upload_data(
                 journal.Image(
-                    id=generate_file_id(uploaded_file),
-                    base64=img_str,
+                    id=file_id,
+                    image_ref=image_ref,
                     title=title,
                     city=city,
                     country=country,
                     date=date,
                     description=text_query,
-                    description_embedding=(
-                        texts_vectors[1].cpu().tolist()
-                        if len(texts_vectors) > 1
-                        else None
-                    ),
+                    description_embedding=description_vector,
                     generated_description=generated_text_query,
-                    generated_description_embedding=texts_vectors[0].cpu().tolist(),
-                    image_vector=image_vector.reshape(-1).cpu().tolist(),
+                    generated_description_embedding=generated_vector,
+                    image_vector=image_vector,
                     tags=tags_query.split(" ") if tags_query else None,
                 ),
             )
             # Free up space
-            del texts, texts_vectors, image_vector
+            del texts, texts_vectors, generated_vector, description_vector, image_vector
             if results:
                 st.success("✅ Image Uploaded")
             else:
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import argparse
+import base64
+import hashlib
+import logging
+import os
+import re
+from io import BytesIO
+from pathlib import Path
+
+from elasticsearch import Elasticsearch
+from elasticsearch import helpers
+from pages.utils.metrics import instrumented
+from pages.utils.metrics import observe_payload
+from PIL import Image
+from pillow_heif import register_heif_opener
+
+register_heif_opener()
+
+SCRIPT_PATH = Path(__file__).parent.absolute()
+LOGGER = logging.getLogger()
+
+DEFAULT_BLOB_DIR = SCRIPT_PATH.parent.parent / "data" / "blobs"
+THUMBNAIL_SIZES = (256, 1024)
+BLOB_ID_REGEX = re.compile(r"^[0-9a-f]{64}$")
+
+
+def get_blob_dir():
+    return Path(os.environ.get("NOSTALGIA_BLOB_DIR", DEFAULT_BLOB_DIR))
+
+
+def hash_bytes(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+def rotated_blob_id(file_id: str, rotation: int = 0):
+    """Blob id of an upload, each rotation of the same file is a different image."""
+    return file_id if not rotation else hash_bytes(f"{file_id}@{rotation}".encode())
+
+
+class BlobStore:
+    """
+    Content-addressed image store on the local filesystem.
+
+    Blobs are keyed by the sha256 of the uploaded file (the same id used for the
+    Elasticsearch document, see `rotated_blob_id` for rotated uploads) and laid
+    out as `<root>/<id[:2]>/<id>/`, holding the full size JPEG plus one
+    pre-generated thumbnail per entry of `thumbnail_sizes`. A stored blob is
+    never rewritten.
+    """
+
+    def __init__(self, root=None, thumbnail_sizes=THUMBNAIL_SIZES, quality: int = 90):
+        self.root = Path(root) if root else get_blob_dir()
+        self.thumbnail_sizes = tuple(sorted(thumbnail_sizes))
+        self.quality = quality
+
+    def _blob_dir(self, blob_id: str) -> Path:
+        if not BLOB_ID_REGEX.match(blob_id or ""):
+            raise ValueError(
+                f"Invalid blob id {blob_id!r}, expected a sha256 hex digest.",
+            )
+        return self.root / blob_id[:2] / blob_id
+
+    def path(self, blob_id: str, size: int | None = None) -> Path:
+        """Path of the original image, or of the thumbnail of the given size."""
+        name = "original.jpg" if size is None else f"thumb_{size}.jpg"
+        return self._blob_dir(blob_id) / name
+
+    def exists(self, blob_id: str) -> bool:
+        return self.path(blob_id).exists()
+
+    def _save(self, image: Image.Image, path: Path):
+        tmp_path = path.with_suffix(".tmp")
+        image.save(tmp_path, format="JPEG", quality=self.quality)
+        os.replace(tmp_path, path)
+
+    def _save_thumbnail(self, image: Image.Image, blob_id: str, size: int):
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size))
+        self._save(thumbnail, self.path(blob_id, size))
+
+    @instrumented("blob_store.put")
+    def put(self, blob_id: str, image: Image.Image) -> str:
+        """Store the image and its thumbnails, returning the reference to index."""
+        if self.exists(blob_id):
+            return blob_id
+        self._blob_dir(blob_id).mkdir(parents=True, exist_ok=True)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        for size in self.thumbnail_sizes:
+            self._save_thumbnail(image, blob_id, size)
+        # The original is written last so `exists` implies a complete blob
+        self._save(image, self.path(blob_id))
+        observe_payload("blob_store.put", self.path(blob_id).stat().st_size)
+        return blob_id
+
+    def thumbnail_path(self, blob_id: str, size: int) -> Path:
+        """Path of the smallest stored thumbnail that is at least `size` pixels."""
+        for thumbnail_size in self.thumbnail_sizes:
+            if thumbnail_size >= size:
+                path = self.path(blob_id, thumbnail_size)
+                if not path.exists() and self.exists(blob_id):
+                    with Image.open(self.path(blob_id)) as image:
+                        self._save_thumbnail(image, blob_id, thumbnail_size)
+                return path
+        return self.path(blob_id)
+
+    def delete(self, blob_id: str) -> bool:
+        blob_dir = self._blob_dir(blob_id)
+        if not blob_dir.exists():
+            return False
+        for path in blob_dir.iterdir():
+            path.unlink()
+        blob_dir.rmdir()
+        return True
+
+
+def migrate_base64_payloads(
+    es_client: Elasticsearch,
+    index_name: str,
+    store: BlobStore,
+    chunk_size: int = 50,
+):
+    """
+    Move the `base64` images of existing documents into the blob store.
+
+    Each migrated document gets an `image_ref` and loses its `base64` field.
+
+    Returns:
+        Tuple with the number of migrated documents and the list of errors.
+    """
+
+    def actions():
+        for hit in helpers.scan(
+            es_client,
+            index=index_name,
+            query={"query": {"exists": {"field": "base64"}}},
+            _source=["base64"],
+            size=chunk_size,
+        ):
+            data = base64.b64decode(hit["_source"]["base64"])
+            blob_id = (
+                hit["_id"] if BLOB_ID_REGEX.match(hit["_id"]) else hash_bytes(data)
+            )
+            with Image.open(BytesIO(data)) as image:
+                store.put(blob_id, image)
+            yield {
+                "_op_type": "update",
+                "_index": index_name,
+                "_id": hit["_id"],
+                "script": {
+                    "source": "ctx._source.image_ref = params.ref; ctx._source.remove('base64')",
+                    "params": {"ref": blob_id},
+                },
+            }
+
+    migrated, errors = helpers.bulk(
+        es_client,
+        actions(),
+        chunk_size=chunk_size,
+        raise_on_error=False,
+    )
+    return migrated, errors
+
+
+if __name__ == "__main__":
+    from pages.utils.elastic import get_client
+
+    parser = argparse.ArgumentParser(description="Manage the local image blob store.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser(
+        "migrate",
+        help="Move base64 payloads out of the index into the blob store.",
+    )
+    migrate_parser.add_argument("--index", default="images")
+    migrate_parser.add_argument("--root", default=None)
+    migrate_parser.add_argument("--chunk-size", type=int, default=50)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "migrate":
+        migrated, errors = migrate_base64_payloads(
+            get_client(),
+            args.index,
+            BlobStore(args.root),
+            chunk_size=args.chunk_size,
+        )
+        LOGGER.info("Migrated %s documents (%s errors)", migrated, len(errors))
+        for error in errors:
+            LOGGER.error(error)
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import datetime
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any
+
+from elasticsearch import Elasticsearch
+from pages.utils.facet_cache import get_facet_cache
+from pages.utils.metrics import es_call
+from pages.utils.metrics import observe_payload
+
+LOGGER = logging.getLogger()
+
+DEFAULT_FLUSH_DOCS = 500
+DEFAULT_FLUSH_BYTES = 10 * 1024 * 1024
+# Rejections because of a full write queue are worth retrying, anything else is not
+RETRY_STATUSES = {429}
+
+
+@dataclass
+class BulkItemFailure:
+    id: str | None
+    action: str
+    # None when the request itself failed
+    status: int | None
+    error: Any
+
+
+class BulkIndexer:
+    """
+    Buffered writer on top of the `_bulk` API.
+
+    Actions are serialized once when added and sent whenever the buffer reaches
+    `flush_docs` documents or `flush_bytes` bytes. Items rejected with a 429 are
+    retried with exponential backoff, every other item error is collected in
+    `failures`. When the request itself fails, its items are collected there too
+    before the error is raised. Use it as a context manager so the remaining
+    buffer is flushed:
+
+        with BulkIndexer(es_client, "images") as writer:
+            for payload in payloads:
+                writer.index(payload, id=payload["id"])
+    """
+
+    def __init__(
+        self,
+        es_client: Elasticsearch,
+        index_name: str,
+        flush_docs: int = DEFAULT_FLUSH_DOCS,
+        flush_bytes: int = DEFAULT_FLUSH_BYTES,
+        max_retries: int = 5,
+        initial_backoff: float = 0.5,
+        max_backoff: float = 30.0,
+        refresh: bool | str = False,
+    ):
+        if es_client is None or not isinstance(es_client, Elasticsearch):
+            raise ValueError("The ElasticSearch client must be valid.")
+        self.es_client = es_client
+        self.index_name = index_name
+        self.flush_docs = flush_docs
+        self.flush_bytes = flush_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.refresh = refresh
+        self.serializer = es_client.transport.serializers.get_serializer(
+            "application/json",
+        )
+        # Each buffered entry holds the serialized lines of one action
+        self._buffer: list[tuple[str | None, str, list[bytes]]] = []
+        self._buffer_bytes = 0
+        self.succeeded = 0
+        self.failures: list[BulkItemFailure] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def _add(self, action: str, id: str | None, metadata: dict, source: dict):
+        lines = [
+            self.serializer.dumps({action: metadata}),
+            self.serializer.dumps(source),
+        ]
+        lines = [
+            line if isinstance(line, bytes) else line.encode("utf-8") for line in lines
+        ]
+        self._buffer.append((id, action, lines))
+        self._buffer_bytes += sum(len(line) + 1 for line in lines)
+        if (
+            len(self._buffer) >= self.flush_docs
+            or self._buffer_bytes >= self.flush_bytes
+        ):
+            self.flush()
+
+    def index(self, document: dict, id: str | None = None):
+        document = {
+            **document,
+            "date_indexed": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+        metadata = {"_index": self.index_name}
+        if id is not None:
+            metadata["_id"] = id
+        self._add("index", id, metadata, document)
+
+    def update(self, id: str, partial: dict):
+        """Partially update a document, only the given fields are written."""
+        self._add(
+            "update",
+            id,
+            {"_index": self.index_name, "_id": id},
+            {"doc": partial},
+        )
+
+    def _send(self, entries):
+        body = b"".join(line + b"\n" for _, _, lines in entries for line in lines)
+        observe_payload("es.bulk", len(body))
+        return es_call(
+            "bulk",
+            self.es_client.bulk,
+            operations=body,
+            refresh=self.refresh,
+        )
+
+    def flush(self):
+        entries, self._buffer, self._buffer_bytes = self._buffer, [], 0
+        if not entries:
+            return
+        try:
+            self._flush(entries)
+        finally:
+            # Cached facets of this index may no longer match its documents
+            get_facet_cache().invalidate(self.index_name)
+
+    def _flush(self, entries):
+        backoff = self.initial_backoff
+        for attempt in range(self.max_retries + 1):
+            if not entries:
+                return
+            try:
+                response = self._send(entries)
+            except Exception as e:
+                # The buffer was already swapped out, don't drop these silently
+                self.failures.extend(
+                    BulkItemFailure(id, action, None, repr(e))
+                    for id, action, _ in entries
+                )
+                raise
+            retries = []
+            for entry, item in zip(entries, response["items"]):
+                id, action, _ = entry
+                result = item[action]
+                status = result.get("status", 200)
+                if status < 300:
+                    self.succeeded += 1
+                elif status in RETRY_STATUSES and attempt < self.max_retries:
+                    retries.append(entry)
+                else:
+                    self.failures.append(
+                        BulkItemFailure(id, action, status, result.get("error")),
+                    )
+            if retries:
+                LOGGER.warning(
+                    "Retrying %s rejected bulk items in %.1fs",
+                    len(retries),
+                    backoff,
+                )
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            entries = retries
+
+
+@contextmanager
+def bulk_import_settings(es_client: Elasticsearch, index_name: str):
+    """
+    Disable refreshes and replicas for the duration of a large import.
+
+    The previous values are restored afterwards (even on failure) and the index
+    is refreshed so the imported documents become searchable.
+    """
+    keys = ["index.refresh_interval", "index.number_of_replicas"]
+    response = es_client.indices.get_settings(
+        index=index_name,
+        name=keys,
+        flat_settings=True,
+    )
+    previous: dict[str, Any] = {key: None for key in keys}
+    for settings in response.values():
+        previous.update(settings["settings"])
+    es_client.indices.put_settings(
+        index=index_name,
+        settings={"index.refresh_interval": "-1", "index.number_of_replicas": 0},
+    )
+    try:
+        yield
+    finally:
+        # A None value resets the setting back to the cluster default
+        es_client.indices.put_settings(index=index_name, settings=previous)
+        es_client.indices.refresh(index=index_name)
@@ -0,0 +1,263 @@
+"""
+Background captioning of indexed photos.
+
+Uploads and imports no longer wait for Gemma: documents are indexed without
+`generated_description` and this worker picks them up from the index, captions
+them in batches and writes the caption and its CLIP embedding back with
+partial bulk updates. It runs inside the Streamlit app or standalone from the
+`app` directory:
+
+    python -m pages.utils.caption_worker --index images
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import threading
+import time
+
+from elasticsearch import Elasticsearch
+from pages.utils.blob_store import BlobStore
+from pages.utils.bulk import BulkIndexer
+from pages.utils.embedding_cache import EmbeddingCache
+from pages.utils.embedding_cache import image_cache_key
+from pages.utils.embedding_cache import text_cache_key
+from pages.utils.image_models import encode_texts
+from pages.utils.image_models import GEMMA_MODEL_ID
+from pages.utils.image_models import generate_image_descriptions
+from pages.utils.image_models import get_clip_cache_id
+from pages.utils.model_registry import get_model_registry
+from pages.utils.model_registry import ModelRegistry
+from PIL import Image
+
+LOGGER = logging.getLogger()
+
+# Gemma looks at 896px, the 1024px thumbnail is enough and much cheaper to decode
+CAPTION_IMAGE_SIZE = 1024
+
+
+class CaptionWorker:
+    """
+    Caption the documents of `index_name` that have an image but no caption.
+
+    The models come from the model registry and are only loaded once there is
+    something to caption, so an idle worker lets them be unloaded. When an
+    `inference_client` is given the captions and embeddings are computed by the
+    inference server instead. Documents that can't be captioned are skipped for
+    the lifetime of the worker instead of being retried on every poll.
+    """
+
+    def __init__(
+        self,
+        es_client: Elasticsearch,
+        index_name: str = "images",
+        blob_store: BlobStore | None = None,
+        embedding_cache: EmbeddingCache | None = None,
+        language: str = "spanish",
+        batch_size: int = 8,
+        poll_interval: float = 5.0,
+        inference_client=None,
+        models: ModelRegistry | None = None,
+    ):
+        self.es_client = es_client
+        self.index_name = index_name
+        self.blob_store = blob_store or BlobStore()
+        self.embedding_cache = embedding_cache or EmbeddingCache()
+        self.language = language
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.inference_client = inference_client
+        self.models = models or get_model_registry()
+        self.captioned = 0
+        self.failed: set[str] = set()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def pending(self, size: int | None = None):
+        """Ids and image refs of the documents still missing a caption, newest first."""
+        if not self.es_client.indices.exists(index=self.index_name):
+            return []
+        response = self.es_client.search(
+            index=self.index_name,
+            size=size or self.batch_size,
+            query={
+                "bool": {
+                    "filter": [{"exists": {"field": "image_ref"}}],
+                    "must_not": [
+                        {"exists": {"field": "generated_description"}},
+                        {"ids": {"values": sorted(self.failed)}},
+                    ],
+                },
+            },
+            sort=[{"date_indexed": {"order": "desc", "unmapped_type": "date"}}],
+            source=["image_ref"],
+        )
+        return [
+            (hit["_id"], hit["_source"]["image_ref"])
+            for hit in response["hits"]["hits"]
+        ]
+
+    def _load_image(self, image_ref):
+        path = self.blob_store.thumbnail_path(image_ref, CAPTION_IMAGE_SIZE)
+        with Image.open(path) as image:
+            return image.convert("RGB")
+
+    def _caption_images(self, images):
+        if self.inference_client:
+            return self.inference_client.captions(images, self.language)
+        with self.models.use("gemma") as (model, processor):
+            return generate_image_descriptions(
+                images,
+                model,
+                processor,
+                language=self.language,
+            )
+
+    def _encode_texts(self, texts):
+        def compute(missing):
+            if self.inference_client:
+                return self.inference_client.encode_texts([texts[i] for i in missing])
+            with self.models.use("clip") as (model, _):
+                return encode_texts([texts[i] for i in missing], model)
+
+        return self.embedding_cache.get_or_compute_vectors(
+            [text_cache_key(text) for text in texts],
+            get_clip_cache_id(),
+            "text_vector",
+            compute,
+        )
+
+    def caption_batch(self, documents):
+        """Caption `documents` (id, image ref pairs) and update them in the index."""
+        kind = f"caption:{self.language}"
+        items = []
+        for id, image_ref in documents:
+            try:
+                items.append((id, image_ref, self._load_image(image_ref)))
+            except (OSError, ValueError):
+                LOGGER.warning("Unable to load the image of %s", id)
+                self.failed.add(id)
+        keys = [image_cache_key(image_ref) for _, image_ref, _ in items]
+        descriptions = [
+            self.embedding_cache.get_text(key, GEMMA_MODEL_ID, kind) for key in keys
+        ]
+        missing = [
+            i for i, description in enumerate(descriptions) if description is None
+        ]
+        if missing:
+            generated = self._caption_images([items[i][2] for i in missing])
+            for i, description in zip(missing, generated):
+                self.embedding_cache.put_text(
+                    keys[i],
+                    GEMMA_MODEL_ID,
+                    kind,
+                    description,
+                )
+                descriptions[i] = description
+
+        captioned = []
+        for (id, _, _), description in zip(items, descriptions):
+            if description and description.strip():
+                captioned.append((id, description))
+            else:
+                LOGGER.warning("Empty caption generated for %s", id)
+                self.failed.add(id)
+        if not captioned:
+            return 0
+        vectors = self._encode_texts([description for _, description in captioned])
+        # Wait for the refresh so the next poll doesn't return the same documents
+        with BulkIndexer(self.es_client, self.index_name, refresh="wait_for") as writer:
+            for (id, description), vector in zip(captioned, vectors):
+                writer.update(
+                    id,
+                    {
+                        "generated_description": description,
+                        "generated_description_embedding": vector,
+                    },
+                )
+        for failure in writer.failures:
+            LOGGER.error(
+                "Unable to update the caption of %s: %s",
+                failure.id,
+                failure.error,
+            )
+            self.failed.add(failure.id)
+        self.captioned += writer.succeeded
+        return writer.succeeded
+
+    def run_once(self):
+        """Caption one batch of pending documents, returning how many were picked up."""
+        documents = self.pending()
+        if documents:
+            self.caption_batch(documents)
+        return len(documents)
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                picked = self.run_once()
+            except Exception:
+                LOGGER.exception("Background captioning failed")
+                picked = 0
+            if not picked:
+                self._stop.wait(self.poll_interval)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self.run,
+                name="caption-worker",
+                daemon=True,
+            )
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: float | None = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+if __name__ == "__main__":
+    from pages.utils.elastic import get_client
+    from pages.utils.inference_client import get_inference_client
+    from pages.utils.metrics import start_metrics_server
+
+    parser = argparse.ArgumentParser(
+        description="Caption the indexed photos missing a caption.",
+    )
+    parser.add_argument("--index", default="images")
+    parser.add_argument("--language", default="spanish")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--poll-interval", type=float, default=5.0)
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Exit when nothing is left.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    start_metrics_server()
+    worker = CaptionWorker(
+        get_client(),
+        args.index,
+        language=args.language,
+        batch_size=args.batch_size,
+        poll_interval=args.poll_interval,
+        inference_client=get_inference_client(),
+    )
+    if args.once:
+        start = time.perf_counter()
+        while worker.run_once():
+            LOGGER.info("%s photos captioned", worker.captioned)
+        LOGGER.info(
+            "Captioned %s photos in %.1fs (%s skipped)",
+            worker.captioned,
+            time.perf_counter() - start,
+            len(worker.failed),
+        )
+    else:
+        worker.run()
@@ -1,68 +1,526 @@
 from __future__ import annotations
 
-import datetime
+import argparse
+import asyncio
+import atexit
 import json
 import logging
 import os
+import re
+import threading
+import time
+from collections import Counter
 from collections import defaultdict
 from collections.abc import MutableMapping
 from pathlib import Path
 from typing import Any
 
+from elasticsearch import ApiError
+from elasticsearch import AsyncElasticsearch
 from elasticsearch import Elasticsearch
+from elasticsearch import TransportError
+from pages.utils.bulk import BulkIndexer
+from pages.utils.facet_cache import get_facet_cache
+from pages.utils.metrics import es_call
+from pages.utils.metrics import es_call_async
+from pages.utils.metrics import instrumented
+from pages.utils.metrics import observe_es
+from pages.utils.serializers import get_vector_serializers
+from pages.utils.serializers import set_base64_vectors
+from pages.utils.serializers import supports_base64_vectors
+from pages.utils.serializers import unpack_vector
 
 SCRIPT_PATH = Path(__file__).parent.absolute()
 LOGGER = logging.getLogger()
 
+FUSION_MODES = ("serial", "msearch", "async")
+SEARCH_ENGINES = ("client", "rrf", "linear")
+# The physical indices are named `<alias>-v<n>`, the app always goes through the alias
+INDEX_VERSION_PATTERN = "{alias}-v{version}"
+# `hnsw` keeps full float graphs, the others quantize the vectors held in memory
+VECTOR_INDEX_TYPES = ("hnsw", "int8_hnsw", "int4_hnsw", "bbq_hnsw")
+VECTOR_FIELDS = [
+    "image_vector",
+    "description_embedding",
+    "generated_description_embedding",
+]
+DEFAULT_LINEAR_WEIGHTS = {"image_vector": 1.0, "text": 1.0, "text_vector": 1.0}
+# Images live in the blob store, legacy documents may still carry the payload
+SOURCE_EXCLUDES = ["base64"]
+# Fields the search page renders, vectors are never needed there
+DISPLAY_FIELDS = [
+    "title",
+    "image_ref",
+    "generated_description",
+    "description",
+    "tags",
+    "date",
+    "city",
+    "country",
+]
 
-def get_client():
+
+def get_es_url():
     es_host = os.environ.get("ELASTICSEARCH_HOST", "localhost")
     es_port = os.environ.get("ELASTICSEARCH_PORT", "9200")
     # TODO: this only applies for clusters created without security enabled (development purposes)
-    es_url = f"http://{es_host}:{es_port}"
-    es = Elasticsearch(es_url)
-    return es
+    return f"http://{es_host}:{es_port}"
+
+
+def get_client_options():
+    """
+    Connection options shared by the sync and async clients.
+
+    Connections are kept alive in a pool of `NOSTALGIA_ES_CONNECTIONS` per
+    node, bodies are gzip compressed (vectors and legacy base64 payloads are
+    large) and requests that time out after `NOSTALGIA_ES_TIMEOUT` seconds are
+    retried up to `NOSTALGIA_ES_MAX_RETRIES` times.
+    """
+    return {
+        "connections_per_node": int(os.environ.get("NOSTALGIA_ES_CONNECTIONS", 10)),
+        "http_compress": os.environ.get("NOSTALGIA_ES_COMPRESS", "1") == "1",
+        "request_timeout": float(os.environ.get("NOSTALGIA_ES_TIMEOUT", 30)),
+        "retry_on_timeout": True,
+        "max_retries": int(os.environ.get("NOSTALGIA_ES_MAX_RETRIES", 3)),
+    }
+
+
+# The version probe fails fast, and isn't retried for a while once it failed, so an
+# unreachable cluster doesn't hold up every page run
+VERSION_PROBE_TIMEOUT = 2.0
+VERSION_PROBE_BACKOFF = 60.0
+
+# Shared by both clients, so the vector format detected on the sync one applies to both
+_SERIALIZERS = get_vector_serializers()
+_NEXT_VERSION_PROBE = 0.0
+_CLIENT: Elasticsearch | None = None
+_ASYNC_CLIENT: AsyncElasticsearch | None = None
+_ASYNC_LOOP: asyncio.AbstractEventLoop | None = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """Process-wide client, its connection pool is reused by every page and thread."""
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = Elasticsearch(
+                get_es_url(),
+                serializers=_SERIALIZERS,
+                **get_client_options(),
+            )
+        configure_vector_format(_CLIENT)
+    return _CLIENT
+
+
+def configure_vector_format(es_client: Elasticsearch):
+    """
+    Send the vectors as base64 float32 when the server accepts it.
+
+    `NOSTALGIA_ES_BASE64_VECTORS` forces the format on (`1`) or off (`0`), by
+    default the server version decides. Vectors are sent as lists until the
+    server has answered once, a failed probe is retried after
+    `VERSION_PROBE_BACKOFF` seconds.
+    """
+    global _NEXT_VERSION_PROBE
+    if _SERIALIZERS["application/json"].base64_vectors is not None:
+        return
+    mode = os.environ.get("NOSTALGIA_ES_BASE64_VECTORS", "auto")
+    if mode != "auto":
+        set_base64_vectors(_SERIALIZERS, mode == "1")
+        return
+    if time.monotonic() < _NEXT_VERSION_PROBE:
+        return
+    try:
+        version = es_client.options(
+            request_timeout=VERSION_PROBE_TIMEOUT,
+            max_retries=0,
+        ).info()["version"]["number"]
+    except (ApiError, TransportError) as e:
+        _NEXT_VERSION_PROBE = time.monotonic() + VERSION_PROBE_BACKOFF
+        LOGGER.warning(
+            "Unable to get the Elasticsearch version, sending vectors as lists: %s",
+            e,
+        )
+        return
+    enabled = supports_base64_vectors(version)
+    set_base64_vectors(_SERIALIZERS, enabled)
+    LOGGER.info(
+        "Elasticsearch %s, sending vectors as %s",
+        version,
+        "base64" if enabled else "lists",
+    )
+
+
+def get_event_loop():
+    """Event loop running on a background thread, the async client lives on it."""
+    global _ASYNC_LOOP
+    with _CLIENT_LOCK:
+        if _ASYNC_LOOP is None:
+            _ASYNC_LOOP = asyncio.new_event_loop()
+            threading.Thread(
+                target=_ASYNC_LOOP.run_forever,
+                name="elasticsearch-async",
+                daemon=True,
+            ).start()
+        return _ASYNC_LOOP
+
+
+def get_async_client():
+    """
+    Process-wide `AsyncElasticsearch` client.
+
+    Its connections belong to the `get_event_loop` loop, so only await it
+    there, e.g. through `run_async`.
+    """
+    global _ASYNC_CLIENT
+    with _CLIENT_LOCK:
+        if _ASYNC_CLIENT is None:
+            _ASYNC_CLIENT = AsyncElasticsearch(
+                get_es_url(),
+                serializers=_SERIALIZERS,
+                **get_client_options(),
+            )
+            atexit.register(_close_async_client)
+        return _ASYNC_CLIENT
+
+
+def _close_async_client():
+    try:
+        run_async(_ASYNC_CLIENT.close(), timeout=5)
+    except Exception:
+        LOGGER.debug("Unable to close the async Elasticsearch client", exc_info=True)
+
+
+def run_async(coroutine, timeout: float | None = None):
+    """Run `coroutine` on the background event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result(timeout)
+
+
+def get_vector_index_type(index_type: str | None = None):
+    """
+    `index_options` type of the dense_vector fields.
+
+    Defaults to `NOSTALGIA_VECTOR_INDEX_TYPE`, None when unset so the server
+    default applies.
+    """
+    index_type = index_type or os.environ.get("NOSTALGIA_VECTOR_INDEX_TYPE") or None
+    if index_type is not None and index_type not in VECTOR_INDEX_TYPES:
+        raise ValueError(
+            f"Unknown vector index type {index_type!r}, expected one of {VECTOR_INDEX_TYPES}",
+        )
+    return index_type
 
 
-def create_index(es_client: Elasticsearch, index_name: str = "images"):
+def load_index_configuration(vector_index_type: str | None = None):
+    """Settings and mappings of `index-settings.json` with the vector index options applied."""
+    with open(os.path.join(SCRIPT_PATH, "index-settings.json")) as f:
+        configuration = json.load(f)
+    index_type = get_vector_index_type(vector_index_type)
+    if index_type:
+        for field in VECTOR_FIELDS:
+            configuration["mappings"]["properties"][field]["index_options"] = {
+                "type": index_type,
+            }
+    return configuration
+
+
+def index_version_name(alias: str, version):
+    return INDEX_VERSION_PATTERN.format(alias=alias, version=version)
+
+
+def resolve_index(es_client: Elasticsearch, index_name: str = "images"):
+    """
+    Concrete indices behind `index_name`.
+
+    An alias resolves to the indices it points to, a concrete (legacy) index to
+    itself and a missing name to an empty list.
+    """
+    if es_client.indices.exists_alias(name=index_name):
+        return sorted(es_client.indices.get_alias(name=index_name))
+    if es_client.indices.exists(index=index_name):
+        return [index_name]
+    return []
+
+
+def index_versions(es_client: Elasticsearch, alias: str = "images"):
+    """Versions of the `<alias>-v<n>` indices that exist, in ascending order."""
+    pattern = re.compile(re.escape(alias) + r"-v(\d+)")
+    indices = es_client.indices.get(
+        index=index_version_name(alias, "*"),
+        expand_wildcards="all",
+    )
+    return sorted(
+        int(match.group(1))
+        for match in map(pattern.fullmatch, indices)
+        if match is not None
+    )
+
+
+def create_versioned_index(
+    es_client: Elasticsearch,
+    alias: str = "images",
+    vector_index_type: str | None = None,
+    settings: dict | None = None,
+):
+    """Create the next `<alias>-v<n>` index with the current mapping, without aliasing it."""
+    versions = index_versions(es_client, alias)
+    index_name = index_version_name(alias, versions[-1] + 1 if versions else 1)
+    configuration = load_index_configuration(vector_index_type)
+    es_client.indices.create(
+        index=index_name,
+        settings={**configuration["settings"], **(settings or {})},
+        mappings=configuration["mappings"],
+    )
+    return index_name
+
+
+def create_index(
+    es_client: Elasticsearch,
+    index_name: str = "images",
+    vector_index_type: str | None = None,
+):
+    """Create `<index_name>-v<n>` behind the `index_name` alias, unless it already exists."""
     if es_client is None or not isinstance(es_client, Elasticsearch):
         raise ValueError("The ElasticSearch client must be valid.")
 
     if es_client.indices.exists(index=index_name):
         return False
     else:
-        with open(os.path.join(SCRIPT_PATH, "index-settings.json")) as f:
-            configuration = json.load(f)
-        es_client.indices.create(
+        target = create_versioned_index(es_client, index_name, vector_index_type)
+        es_client.indices.put_alias(index=target, name=index_name)
+        get_facet_cache().invalidate(index_name)
+        return True
+
+
+def update_vector_index_options(
+    es_client: Elasticsearch,
+    index_name: str,
+    vector_index_type: str,
+    force_merge: bool = False,
+):
+    """
+    Switch the dense_vector fields of an existing index to `vector_index_type`.
+
+    Elasticsearch only accepts upgrades (`hnsw` to `int8_hnsw`, `int4_hnsw` or
+    `bbq_hnsw`, in that order), other changes fail with an `ApiError`. New
+    segments use the new options right away, existing ones when they are
+    merged: `force_merge` rewrites the whole index into a single segment.
+    """
+    if es_client is None or not isinstance(es_client, Elasticsearch):
+        raise ValueError("The ElasticSearch client must be valid.")
+    if not vector_index_type:
+        raise ValueError("A vector index type is required.")
+
+    properties = load_index_configuration(vector_index_type)["mappings"]["properties"]
+    es_client.indices.put_mapping(
+        index=index_name,
+        properties={field: properties[field] for field in VECTOR_FIELDS},
+    )
+    if force_merge:
+        # Merging a large index outlasts the default timeout, a retry would only queue another merge
+        es_client.options(
+            request_timeout=None,
+            retry_on_timeout=False,
+        ).indices.forcemerge(
             index=index_name,
-            settings=configuration["settings"],
-            mappings=configuration["mappings"],
+            max_num_segments=1,
         )
-        return True
+    return True
 
 
 def delete_index(es_client: Elasticsearch, index_name: str = "images"):
+    """Delete `index_name` or, for an alias, every index behind it."""
     if es_client is None or not isinstance(es_client, Elasticsearch):
         raise ValueError("The ElasticSearch client must be valid.")
 
-    if es_client.indices.exists(index=index_name):
-        es_client.indices.delete(index=index_name)
+    indices = resolve_index(es_client, index_name)
+    if indices:
+        es_client.indices.delete(index=indices)
+        get_facet_cache().invalidate(index_name)
         return True
     else:
         return False
 
 
+def _wait_for_task(es_client: Elasticsearch, task_id: str, poll_interval: float):
+    while True:
+        task = es_client.tasks.get(task_id=task_id)
+        status = task["task"]["status"]
+        if task["completed"]:
+            return task
+        LOGGER.info(
+            "Reindexed %s/%s documents",
+            status.get("created", 0) + status.get("updated", 0),
+            status.get("total", "?"),
+        )
+        time.sleep(poll_interval)
+
+
+def migrate_index(
+    es_client: Elasticsearch,
+    alias: str = "images",
+    vector_index_type: str | None = None,
+    slices: int | str = "auto",
+    delete_old: bool = False,
+    poll_interval: float = 5.0,
+):
+    """
+    Copy the documents behind `alias` into a new index with the current mapping.
+
+    The stored vectors and captions are reindexed as they are, so changing
+    `index-settings.json` or the vector options doesn't run the models again.
+    The source is write-blocked while the sliced `_reindex` runs, and the alias
+    is swapped to the new index in a single atomic `_aliases` call once the
+    document counts match. A legacy concrete index named like the alias is
+    deleted by that same call, since both can't coexist; otherwise the previous
+    versions are kept (still write-blocked) for a rollback unless `delete_old`.
+
+    Returns:
+        str: Name of the new index.
+    """
+    if es_client is None or not isinstance(es_client, Elasticsearch):
+        raise ValueError("The ElasticSearch client must be valid.")
+
+    sources = resolve_index(es_client, alias)
+    if not sources:
+        raise ValueError(f"Nothing to migrate, {alias!r} doesn't exist.")
+    legacy = sources == [alias]
+
+    # Replicas and refreshes only slow the copy down, they are restored before the swap
+    target = create_versioned_index(
+        es_client,
+        alias,
+        vector_index_type,
+        settings={"number_of_replicas": 0, "refresh_interval": "-1"},
+    )
+    LOGGER.info("Migrating %s (%s) to %s", alias, ", ".join(sources), target)
+    es_client.indices.add_block(index=sources, block="write")
+    task_id = None
+    try:
+        response = es_client.reindex(
+            source={"index": sources, "size": 1000},
+            dest={"index": target, "op_type": "create"},
+            slices=slices,
+            wait_for_completion=False,
+        )
+        task_id = response["task"]
+        result = _wait_for_task(es_client, task_id, poll_interval).get(
+            "response",
+            {},
+        )
+        task_id = None
+        if result.get("failures"):
+            raise RuntimeError(
+                f"Reindex into {target} failed: {result['failures'][:3]}",
+            )
+
+        replicas = es_client.indices.get_settings(
+            index=sources[0],
+            name="index.number_of_replicas",
+        )
+        es_client.indices.put_settings(
+            index=target,
+            settings={
+                "number_of_replicas": replicas[sources[0]]["settings"]["index"][
+                    "number_of_replicas"
+                ],
+                "refresh_interval": None,
+            },
+        )
+        es_client.indices.refresh(index=target)
+        expected = es_client.count(index=sources)["count"]
+        copied = es_client.count(index=target)["count"]
+        if copied != expected:
+            raise RuntimeError(f"{target} has {copied} documents, expected {expected}")
+    except BaseException:
+        es_client.indices.put_settings(
+            index=sources,
+            settings={"index.blocks.write": False},
+        )
+        cancelled = True
+        if task_id is not None:
+            # A running reindex would auto-create the target again after its deletion
+            try:
+                es_client.tasks.cancel(task_id=task_id, wait_for_completion=True)
+            except (ApiError, TransportError) as e:
+                cancelled = isinstance(e, ApiError) and e.meta.status == 404
+                if not cancelled:
+                    LOGGER.error("Unable to cancel the reindex task %s: %s", task_id, e)
+        if cancelled:
+            es_client.indices.delete(index=target, ignore_unavailable=True)
+        else:
+            LOGGER.error("%s was kept, delete it once task %s ends", target, task_id)
+        LOGGER.error(
+            "Migration failed, %s still points to %s",
+            alias,
+            ", ".join(sources),
+        )
+        raise
+
+    if legacy:
+        actions = [{"remove_index": {"index": alias}}]
+    else:
+        actions = [{"remove": {"index": source, "alias": alias}} for source in sources]
+    es_client.indices.update_aliases(
+        actions=actions + [{"add": {"index": target, "alias": alias}}],
+    )
+    get_facet_cache().invalidate(alias)
+    LOGGER.info("%s now points to %s (%s documents)", alias, target, copied)
+    if delete_old and not legacy:
+        es_client.indices.delete(index=sources)
+    return target
+
+
+@instrumented("elastic.index_data")
 def index_data(es_client: Elasticsearch, index_name: str, payload: dict):
+    """
+    Index a single document, batch importers should use `BulkIndexer` directly.
+
+    A missing index is reported by the bulk item itself (`index_not_found_exception`),
+    so the document is sent without checking for the index first.
+    """
     if es_client is None or not isinstance(es_client, Elasticsearch):
         raise ValueError("The ElasticSearch client must be valid.")
 
     id = payload.get("id", None)
-    if es_client.indices.exists(index=index_name):
-        payload["date_indexed"] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-        es_client.index(index=index_name, id=id, document=payload)
-        return True
-    else:
-        return False
+    with BulkIndexer(es_client, index_name) as writer:
+        writer.index(payload, id=id)
+    for failure in writer.failures:
+        LOGGER.error("Unable to index %s: %s", failure.id, failure.error)
+    return not writer.failures
+
+
+def generate_facet_aggs(fields: list[str], size=20):
+    return {
+        f"{field}_facet": {"terms": {"field": field, "size": size}} for field in fields
+    }
+
+
+def parse_facets(aggregations, fields: list[str]):
+    """Buckets of `generate_facet_aggs`, as a value to document count dict per field."""
+    return {
+        field: {
+            bucket["key"]: bucket["doc_count"]
+            for bucket in aggregations[f"{field}_facet"]["buckets"]
+        }
+        for field in fields
+    }
+
+
+def count_facets(hits, fields: list[str], size=20):
+    """
+    Value counts of `fields` among `hits`, in the format of `parse_facets`.
+
+    The values are read from the `fields` of the hits, so the searches need
+    `docvalue_fields` set to `fields`.
+    """
+    counts: dict[str, Counter] = {field: Counter() for field in fields}
+    for hit in hits:
+        values = hit.get("fields", {})
+        for field in fields:
+            counts[field].update(set(values.get(field, [])))
+    return {field: dict(counts[field].most_common(size)) for field in fields}
 
 
 def get_facets(
@@ -71,31 +529,50 @@ def get_facets(
     fields: list[str],
     filters,
     size=20,
+    use_cache=True,
 ):
-    payload: MutableMapping = {
-        "size": 0,
-        "query": {
-            "bool": {
-                "must": {
-                    "match_all": {},
+    """
+    Value counts of `fields` among the documents matching `filters`.
+
+    Results are served from the facet cache until it expires or the index is
+    written, pass `use_cache=False` to always query the index.
+    """
+
+    def compute():
+        payload: MutableMapping = {
+            "size": 0,
+            "query": {
+                "bool": {
+                    "must": {
+                        "match_all": {},
+                    },
+                    **generate_filters(filters),
                 },
-                **generate_filters(filters),
             },
-        },
-        "aggs": {},
-    }
-    for field in fields:
-        payload["aggs"][f"{field}_facet"] = {
-            "terms": {"field": field, "size": size},
+            "aggs": generate_facet_aggs(fields, size),
         }
-    response = es_client.search(index=index_name, body=payload)
-    results = {}
-    for field in fields:
-        results[field] = [
-            bucket["key"]
-            for bucket in response["aggregations"][f"{field}_facet"]["buckets"]
-        ]
-    return results
+        response = es_call("facets", es_client.search, index=index_name, body=payload)
+        return parse_facets(response["aggregations"], fields)
+
+    if not use_cache:
+        return compute()
+    return get_facet_cache().get_or_compute(
+        index_name,
+        get_facet_cache().key(fields, filters, size),
+        compute,
+    )
+
+
+def query_label(query):
+    """Short name of a sub-query for the metrics, e.g. `knn:image_vector`."""
+    if "aggs" in query:
+        return "facets"
+    if "knn" in query:
+        return f"knn:{query['knn']['field']}"
+    script_score = query.get("query", {}).get("script_score")
+    if script_score:
+        return f"exact:{script_score['script']['params']['field']}"
+    return "text"
 
 
 def generate_knn_search(query_vector, knn_k, top_n, filter_dict, window_size: int = 10):
@@ -108,18 +585,71 @@ def generate_knn_search(query_vector, knn_k, top_n, filter_dict, window_size: in
                 "num_candidates": top_n,
                 **filter_dict,
             },
-            # NOTE: we could also embed a query statement before knn and set weights for a hybrid "or"
-            # NOTE: score = 0.9 * match_score + 0.1 * knn_score
-            # NOTE: We could add a "rescore" with precise cosine similarity
         }
-        for field in [
-            "image_vector",
-            "description_embedding",
-            "description_generated_embedding",
-        ]
+        for field in VECTOR_FIELDS
     ]
 
 
+def generate_exact_knn_search(query, ids):
+    """
+    Exact counterpart of a `knn` sub-query, restricted to the documents `ids`.
+
+    The HNSW graph, quantized or not, only approximates the nearest neighbours.
+    `script_score` computes the cosine on the stored float vectors instead,
+    scaled like the `knn` score. The field is a script parameter so a single
+    compiled script serves every field.
+    """
+    knn = query["knn"]
+    return {
+        "size": knn["k"],
+        "query": {
+            "script_score": {
+                "query": {
+                    "bool": {
+                        "filter": [
+                            {"ids": {"values": ids}},
+                            {"exists": {"field": knn["field"]}},
+                        ],
+                    },
+                },
+                "script": {
+                    "source": "(cosineSimilarity(params.query_vector, params.field) + 1.0) / 2.0",
+                    # Painless needs a list, not the packed vector of the knn search
+                    "params": {
+                        "query_vector": unpack_vector(knn["query_vector"]).tolist(),
+                        "field": knn["field"],
+                    },
+                },
+            },
+        },
+    }
+
+
+def generate_text_search(text_query, filter_dict):
+    return {
+        "query": {
+            "bool": {
+                "must": {
+                    "multi_match": {
+                        "query": text_query,
+                        "type": "most_fields",
+                        "fields": [
+                            "title^1",
+                            "description^3",
+                            "city^0.5",
+                            "country^0.5",
+                            "generated_description^2",
+                        ],
+                        "operator": "or",
+                        "fuzziness": "auto",
+                    },
+                },
+                **filter_dict,
+            },
+        },
+    }
+
+
 def generate_filters(filters):
     filter_dict: dict[str, Any] = {"filter": []}
     if filters:
@@ -145,7 +675,102 @@ def generate_filters(filters):
     return filter_dict
 
 
-def search_data(
+def generate_queries(
+    image_vector=None,
+    text_query=None,
+    text_vector=None,
+    filter_dict=None,
+    knn_k=5,
+    top_n=100,
+):
+    """
+    Build the sub-queries of a hybrid search.
+
+    Returns:
+        List of (kind, query) tuples, where kind is one of the keys of
+        `DEFAULT_LINEAR_WEIGHTS` and query is a `knn` or `query` search body.
+    """
+    filter_dict = filter_dict if filter_dict is not None else generate_filters(None)
+    queries = []
+    if image_vector is not None:
+        for query in generate_knn_search(image_vector, knn_k, top_n, filter_dict):
+            queries.append(("image_vector", query))
+    if text_query:
+        queries.append(("text", generate_text_search(text_query, filter_dict)))
+    if text_vector is not None:
+        for query in generate_knn_search(text_vector, knn_k, top_n, filter_dict):
+            queries.append(("text_vector", query))
+    return queries
+
+
+def generate_retriever(queries, engine="rrf", rrf_k=60, top_n=100, weights=None):
+    """
+    Combine the sub-queries into a single server-side `retriever`.
+
+    Args:
+        queries (list of tuple): Output of `generate_queries`.
+        engine (str): `rrf` for Reciprocal Rank Fusion or `linear` for a
+            weighted sum of min-max normalized scores.
+        rrf_k (int): RRF constant (typically 60).
+        top_n (int): Number of candidates each sub-retriever contributes.
+        weights (dict): Weight per query kind for the `linear` engine.
+    """
+    retrievers = []
+    for kind, query in queries:
+        if "knn" in query:
+            retrievers.append((kind, {"knn": query["knn"]}))
+        else:
+            retrievers.append((kind, {"standard": {"query": query["query"]}}))
+    if len(retrievers) == 1:
+        return retrievers[0][1]
+    if engine == "rrf":
+        return {
+            "rrf": {
+                "retrievers": [retriever for _, retriever in retrievers],
+                "rank_constant": rrf_k,
+                "rank_window_size": top_n,
+            },
+        }
+    elif engine == "linear":
+        weights = {**DEFAULT_LINEAR_WEIGHTS, **(weights or {})}
+        return {
+            "linear": {
+                "retrievers": [
+                    {
+                        "retriever": retriever,
+                        "weight": weights[kind],
+                        "normalizer": "minmax",
+                    }
+                    for kind, retriever in retrievers
+                ],
+                "rank_window_size": top_n,
+            },
+        }
+    else:
+        raise ValueError(f"Unknown server-side engine {engine!r}")
+
+
+def get_source_filter(ids_only=False):
+    """`_source` value for searches, `False` when only ids and scores are needed."""
+    if ids_only:
+        return False
+    return {"excludes": SOURCE_EXCLUDES}
+
+
+def with_docvalue_fields(search, docvalue_fields):
+    """`search` also returning `docvalue_fields` in the `fields` of its hits."""
+    if not docvalue_fields:
+        return search
+    return {**search, "docvalue_fields": docvalue_fields}
+
+
+def search_data(es_client: Elasticsearch, index_name: str, *args, **kwargs):
+    """Run a hybrid search, see `search_with_facets` for the arguments."""
+    return search_with_facets(es_client, index_name, *args, **kwargs)[0]
+
+
+@instrumented("elastic.search_data")
+def search_with_facets(
     es_client: Elasticsearch,
     index_name: str,
     image_vector=None,
@@ -155,90 +780,297 @@ def search_data(
     knn_k=5,
     rrf_k=60,
     top_n=100,
+    fusion_mode="msearch",
+    engine="client",
+    weights=None,
+    ids_only=False,
+    rescore_window=0,
+    facet_fields=None,
+    facet_size=20,
 ):
-    queries = []
+    """
+    Run a hybrid search over images, text and text embeddings.
+
+    `engine` selects where the sub-queries are fused: `client` runs them and
+    applies `reciprocal_rank_fusion` here, while `rrf` and `linear` send a
+    single `retriever` request so only the fused top-N crosses the wire. The
+    server-side engines fall back to the client path when the request fails
+    (e.g. on clusters or licenses without retriever support).
+
+    With `ids_only` the hits carry no `_source`, use `hydrate_hits` to fetch
+    the documents of the page being shown. A `rescore_window` re-ranks the
+    vector sub-queries of the client engine with exact cosine similarity, see
+    `rescore_exact`.
+
+    With `facet_fields` the value counts of those fields among the returned
+    hits are computed too. The searches fetch the fields as `docvalue_fields`,
+    so no extra request is needed.
+
+    Returns:
+        tuple: The hits and the facets (see `parse_facets`), None without
+        `facet_fields`.
+    """
+    if engine not in SEARCH_ENGINES:
+        raise ValueError(f"Unknown engine {engine!r}, expected one of {SEARCH_ENGINES}")
+    source = get_source_filter(ids_only)
     filter_dict = generate_filters(filters)
-    if image_vector:
-        queries += generate_knn_search(image_vector, knn_k, top_n, filter_dict)
-    if text_query:
-        queries.append(
-            {
-                "query": {
-                    "bool": {
-                        "must": {
-                            "multi_match": {
-                                "query": text_query,
-                                "type": "most_fields",
-                                "fields": [
-                                    "title^1",
-                                    "description^3",
-                                    "city^0.5",
-                                    "country^0.5",
-                                    "generated_description^2",
-                                ],
-                                "operator": "or",
-                                "fuzziness": "auto",
-                            },
-                        },
-                        **filter_dict,
-                    },
-                },
-            },
+    queries = generate_queries(
+        image_vector=image_vector,
+        text_query=text_query,
+        text_vector=text_vector,
+        filter_dict=filter_dict,
+        knn_k=knn_k,
+        top_n=top_n,
+    )
+    if queries and engine != "client":
+        retriever = generate_retriever(
+            queries,
+            engine=engine,
+            rrf_k=rrf_k,
+            top_n=top_n,
+            weights=weights,
         )
-    if text_vector:
-        queries += generate_knn_search(text_vector, knn_k, top_n, filter_dict)
+        try:
+            response = es_call(
+                "retriever",
+                es_client.search,
+                index=index_name,
+                size=top_n,
+                retriever=retriever,
+                source=source,
+                docvalue_fields=facet_fields,
+                labels={"engine": engine},
+            )
+            hits = response["hits"]["hits"]
+            return hits, (
+                count_facets(hits, facet_fields, facet_size) if facet_fields else None
+            )
+        except ApiError as e:
+            LOGGER.warning(
+                "Server-side %s retrieval failed, falling back to client fusion: %s",
+                engine,
+                e,
+            )
     if queries:
-        return reciprocal_rank_fusion(
+        hits = reciprocal_rank_fusion(
             es_client=es_client,
             index_name=index_name,
-            queries=queries,
+            queries=[query for _, query in queries],
             k=rrf_k,
             top_n=top_n,
+            mode=fusion_mode,
+            ids_only=ids_only,
+            rescore_window=rescore_window,
+            docvalue_fields=facet_fields,
         )
     else:
-        query = {
-            "query": {"bool": {**filter_dict}},
-        }
-        return es_client.search(index=index_name, size=top_n, body=query)["hits"][
-            "hits"
-        ]
+        response = es_call(
+            "search",
+            es_client.search,
+            index=index_name,
+            size=top_n,
+            query={"bool": {**filter_dict}},
+            source=source,
+            docvalue_fields=facet_fields,
+            labels={"query": "filters"},
+        )
+        hits = response["hits"]["hits"]
+    return hits, count_facets(hits, facet_fields, facet_size) if facet_fields else None
 
 
-def reciprocal_rank_fusion(
+@instrumented("elastic.hydrate_hits")
+def hydrate_hits(es_client, index_name, hits, fields=None):
+    """
+    Fetch the `_source` of the given hits with a single `mget`.
+
+    Args:
+        es_client: An instance of Elasticsearch client.
+        index_name (str): The index name.
+        hits (list of dict): Hits returned by an `ids_only` search.
+        fields (list of str): `_source` fields to include, `DISPLAY_FIELDS` by default.
+
+    Returns:
+        List of dicts: The hits, in the same order, with their `_source` set.
+        Documents deleted since the search are dropped.
+    """
+    if not hits:
+        return []
+    response = es_call(
+        "mget",
+        es_client.mget,
+        index=index_name,
+        ids=[hit["_id"] for hit in hits],
+        source_includes=fields or DISPLAY_FIELDS,
+    )
+    sources = {
+        doc["_id"]: doc["_source"] for doc in response["docs"] if doc.get("found")
+    }
+    hydrated = []
+    for hit in hits:
+        if hit["_id"] in sources:
+            hydrated.append({**hit, "_source": sources[hit["_id"]]})
+    return hydrated
+
+
+def run_searches_serial(es_client, index_name, searches, top_n=100, source=None):
+    """Run the search bodies one after another, returning their responses."""
+    source = source if source is not None else get_source_filter()
+    return [
+        es_call(
+            "search",
+            es_client.search,
+            index=index_name,
+            labels={"query": query_label(search)},
+            **{"size": top_n, "source": source, **search},
+        )
+        for search in searches
+    ]
+
+
+def run_searches_msearch(es_client, index_name, searches, top_n=100, source=None):
+    """
+    Send every search body in a single `_msearch` round trip.
+
+    The responses come back in the same order as the searches, so the fused
+    output is identical to running the queries one after another.
+    """
+    if not searches:
+        return []
+    source = source if source is not None else get_source_filter()
+    body: list[dict] = []
+    for search in searches:
+        body.append({})
+        body.append({"size": top_n, "_source": source, **search})
+    response = es_call("msearch", es_client.msearch, index=index_name, searches=body)
+    responses = []
+    for i, (search, item) in enumerate(zip(searches, response["responses"])):
+        if "error" in item:
+            raise RuntimeError(f"Sub-query {i} failed: {item['error']}")
+        observe_es("msearch.item", None, item.get("took"), query=query_label(search))
+        responses.append(item)
+    return responses
+
+
+async def run_searches_async(
+    async_client,
+    index_name,
+    searches,
+    top_n=100,
+    source=None,
+):
+    source = source if source is not None else get_source_filter()
+    return await asyncio.gather(
+        *(
+            es_call_async(
+                "search",
+                async_client.search,
+                index=index_name,
+                labels={"query": query_label(search), "mode": "async"},
+                **{"size": top_n, "source": source, **search},
+            )
+            for search in searches
+        ),
+    )
+
+
+def _run_searches_async_blocking(
+    async_client,
+    index_name,
+    searches,
+    top_n=100,
+    source=None,
+):
+    if async_client is None:
+        return run_async(
+            run_searches_async(get_async_client(), index_name, searches, top_n, source),
+        )
+    return asyncio.run(
+        run_searches_async(async_client, index_name, searches, top_n, source),
+    )
+
+
+def run_queries_serial(es_client, index_name, queries, top_n=100, source=None):
+    responses = run_searches_serial(es_client, index_name, queries, top_n, source)
+    return [response["hits"]["hits"] for response in responses]
+
+
+def run_queries_msearch(es_client, index_name, queries, top_n=100, source=None):
+    responses = run_searches_msearch(es_client, index_name, queries, top_n, source)
+    return [response["hits"]["hits"] for response in responses]
+
+
+async def run_queries_async(async_client, index_name, queries, top_n=100, source=None):
+    responses = await run_searches_async(
+        async_client,
+        index_name,
+        queries,
+        top_n,
+        source,
+    )
+    return [response["hits"]["hits"] for response in responses]
+
+
+@instrumented("elastic.rescore_exact")
+def rescore_exact(
     es_client,
     index_name,
     queries,
-    top_n=100,
+    hits_per_query,
+    window,
     k=60,
+    source=None,
+    docvalue_fields=None,
 ):
     """
-    Perform Reciprocal Rank Fusion (RRF) on multiple query results.
+    Re-rank the `knn` sub-queries exactly over the best fused candidates.
+
+    The hits are fused once, then every `knn` sub-query is replaced by its
+    exact cosine ranking over the top `window` candidates, all of them sent in
+    one `_msearch`. Candidates a quantized graph ranked too low move up and
+    the text sub-query is left untouched, so fusing the result again keeps the
+    RRF semantics.
+
+    Returns:
+        List of list of dict: The hits of each sub-query, in the order of `queries`.
+    """
+    positions = [i for i, query in enumerate(queries) if "knn" in query]
+    candidates = [hit["_id"] for hit in fuse_hits(hits_per_query, k=k)[:window]]
+    if not positions or not candidates:
+        return hits_per_query
+    exact_hits = run_queries_msearch(
+        es_client,
+        index_name,
+        [
+            with_docvalue_fields(
+                generate_exact_knn_search(queries[i], candidates),
+                docvalue_fields,
+            )
+            for i in positions
+        ],
+        source=source,
+    )
+    rescored = list(hits_per_query)
+    for i, hits in zip(positions, exact_hits):
+        rescored[i] = hits
+    return rescored
+
+
+@instrumented("elastic.fuse_hits")
+def fuse_hits(hits_per_query, k=60):
+    """
+    Fuse ranked hit lists with Reciprocal Rank Fusion.
 
     Args:
-        es_client: An instance of Elasticsearch client.
-        index_name (str): The index name.
-        queries (list of str): List of query strings.
-        query_field (str): The field to match in the documents.
-        top_n (int): Number of top results to retrieve from each query.
+        hits_per_query (list of list of dict): Hits of each sub-query, in rank order.
         k (int): RRF constant (typically 60).
 
     Returns:
         List of dicts: Documents with their RRF scores, sorted descending.
     """
-    rrf_scores = defaultdict(float)
+    rrf_scores: defaultdict[str, float] = defaultdict(float)
     doc_data = dict()  # To store document contents (optional)
 
-    def run_query(q):
-        response = es_client.search(
-            index=index_name,
-            size=top_n,
-            **q,
-        )
-        hits = response["hits"]["hits"]
-        return hits
-
-    for query in queries:
-        hits = run_query(query)
+    for hits in hits_per_query:
         for rank, hit in enumerate(hits):
             doc_id = hit["_id"]
             rrf_scores[doc_id] += 1 / (k + rank + 1)
@@ -255,3 +1087,138 @@ def reciprocal_rank_fusion(
         output.append(doc)
 
     return output
+
+
+@instrumented("elastic.reciprocal_rank_fusion")
+def reciprocal_rank_fusion(
+    es_client,
+    index_name,
+    queries,
+    top_n=100,
+    k=60,
+    mode="msearch",
+    async_client=None,
+    ids_only=False,
+    rescore_window=0,
+    docvalue_fields=None,
+):
+    """
+    Perform Reciprocal Rank Fusion (RRF) on multiple query results.
+
+    Args:
+        es_client: An instance of Elasticsearch client.
+        index_name (str): The index name.
+        queries (list of dict): List of search bodies (`query` or `knn`).
+        top_n (int): Number of top results to retrieve from each query.
+        k (int): RRF constant (typically 60).
+        mode (str): How the sub-queries are sent. `serial` runs one search per
+            query, `msearch` sends all of them in one `_msearch` request and
+            `async` runs them concurrently on an `AsyncElasticsearch` client.
+        async_client: Optional `AsyncElasticsearch` client for the `async` mode.
+            The shared client of `get_async_client` is used when omitted.
+        ids_only (bool): Only retrieve ids and scores, without `_source`.
+        rescore_window (int): Re-rank the `knn` sub-queries with exact cosine
+            similarity over this many fused candidates, 0 to disable.
+        docvalue_fields (list of str): Fields returned in the `fields` of every hit.
+
+    Returns:
+        List of dicts: Documents with their RRF scores, sorted descending.
+    """
+    source = get_source_filter(ids_only)
+    searches = [with_docvalue_fields(query, docvalue_fields) for query in queries]
+    if mode == "serial":
+        hits_per_query = run_queries_serial(
+            es_client,
+            index_name,
+            searches,
+            top_n,
+            source,
+        )
+    elif mode == "msearch":
+        hits_per_query = run_queries_msearch(
+            es_client,
+            index_name,
+            searches,
+            top_n,
+            source,
+        )
+    elif mode == "async":
+        responses = _run_searches_async_blocking(
+            async_client,
+            index_name,
+            searches,
+            top_n,
+            source,
+        )
+        hits_per_query = [response["hits"]["hits"] for response in responses]
+    else:
+        raise ValueError(
+            f"Unknown fusion mode {mode!r}, expected one of {FUSION_MODES}",
+        )
+    if rescore_window:
+        hits_per_query = rescore_exact(
+            es_client,
+            index_name,
+            queries,
+            hits_per_query,
+            rescore_window,
+            k=k,
+            source=source,
+            docvalue_fields=docvalue_fields,
+        )
+    return fuse_hits(hits_per_query, k=k)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the photo index.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    vector_options = commands.add_parser(
+        "vector-options",
+        help="Switch the vector fields of an existing index to another index type.",
+    )
+    vector_options.add_argument("--index", default="images")
+    vector_options.add_argument("--type", choices=VECTOR_INDEX_TYPES, required=True)
+    vector_options.add_argument(
+        "--force-merge",
+        action="store_true",
+        help="Rewrite the existing segments now instead of on the next merges.",
+    )
+    migrate = commands.add_parser(
+        "migrate",
+        help="Reindex the alias into a new index with the current mapping and swap the alias.",
+    )
+    migrate.add_argument(
+        "--index",
+        default="images",
+        help="Alias (or legacy index) to migrate.",
+    )
+    migrate.add_argument("--type", choices=VECTOR_INDEX_TYPES, default=None)
+    migrate.add_argument(
+        "--slices",
+        default="auto",
+        help="Parallel reindex slices, or auto.",
+    )
+    migrate.add_argument(
+        "--delete-old",
+        action="store_true",
+        help="Delete the previous version.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if args.command == "vector-options":
+        update_vector_index_options(
+            get_client(),
+            args.index,
+            args.type,
+            args.force_merge,
+        )
+        LOGGER.info("Vector fields of %s now use %s", args.index, args.type)
+    elif args.command == "migrate":
+        migrate_index(
+            get_client(),
+            args.index,
+            vector_index_type=args.type,
+            slices=int(args.slices) if args.slices.isdigit() else args.slices,
+            delete_old=args.delete_old,
+        )
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+from collections.abc import Sequence
+from pathlib import Path
+
+import numpy as np
+
+SCRIPT_PATH = Path(__file__).parent.absolute()
+LOGGER = logging.getLogger()
+
+DEFAULT_CACHE_PATH = SCRIPT_PATH.parent.parent / "data" / "embedding-cache.sqlite3"
+DEFAULT_MAX_MB = 1024
+# Evict down to this fraction of the budget so eviction doesn't run on every put
+EVICTION_TARGET = 0.9
+
+
+def image_cache_key(file_id: str, rotation: int = 0):
+    """Cache key of an uploaded image, the rotation changes what the models see."""
+    return file_id if not rotation else f"{file_id}@{rotation}"
+
+
+def text_cache_key(text: str):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of model outputs keyed by content hash and model id.
+
+    Vectors are stored as raw float32 bytes and captions as UTF-8 text in a
+    single SQLite file. When the stored payload exceeds `max_bytes` the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, path=None, max_bytes: int | None = None):
+        if path is None:
+            path = os.environ.get("NOSTALGIA_EMBEDDING_CACHE", DEFAULT_CACHE_PATH)
+        if max_bytes is None:
+            max_mb = int(os.environ.get("NOSTALGIA_EMBEDDING_CACHE_MB", DEFAULT_MAX_MB))
+            max_bytes = max_mb * 1024 * 1024
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT NOT NULL,
+                    model_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (key, model_id, kind)
+                )
+                """,
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)",
+            )
+            self._size = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries",
+            ).fetchone()[0]
+
+    def _get(self, key: str, model_id: str, kind: str) -> bytes | None:
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT value FROM entries WHERE key = ? AND model_id = ? AND kind = ?",
+                (key, model_id, kind),
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ? AND model_id = ? AND kind = ?",
+                (time.time(), key, model_id, kind),
+            )
+        return row[0]
+
+    def _put(self, key: str, model_id: str, kind: str, value: bytes):
+        with self._lock, self._connection:
+            previous = self._connection.execute(
+                "SELECT size FROM entries WHERE key = ? AND model_id = ? AND kind = ?",
+                (key, model_id, kind),
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_id, kind, value, len(value), time.time()),
+            )
+            self._size += len(value) - (previous[0] if previous else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        target = self.max_bytes * EVICTION_TARGET
+        rows = self._connection.execute(
+            "SELECT key, model_id, kind, size FROM entries ORDER BY last_access",
+        )
+        evicted = []
+        for key, model_id, kind, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key, model_id, kind))
+            self._size -= size
+        self._connection.executemany(
+            "DELETE FROM entries WHERE key = ? AND model_id = ? AND kind = ?",
+            evicted,
+        )
+        LOGGER.info("Evicted %s entries from the embedding cache", len(evicted))
+
+    def get_vector(self, key: str, model_id: str, kind: str) -> np.ndarray | None:
+        value = self._get(key, model_id, kind)
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=np.float32)
+
+    def put_vector(self, key: str, model_id: str, kind: str, vector):
+        vector = np.ascontiguousarray(vector, dtype=np.float32).reshape(-1)
+        self._put(key, model_id, kind, vector.tobytes())
+
+    def get_text(self, key: str, model_id: str, kind: str) -> str | None:
+        value = self._get(key, model_id, kind)
+        return None if value is None else value.decode("utf-8")
+
+    def put_text(self, key: str, model_id: str, kind: str, text: str):
+        self._put(key, model_id, kind, text.encode("utf-8"))
+
+    def get_or_compute_vectors(
+        self,
+        keys: Sequence[str],
+        model_id: str,
+        kind: str,
+        compute: Callable[[list[int]], Sequence],
+    ) -> list[np.ndarray]:
+        """
+        Look up the vectors of `keys`, computing only the missing ones.
+
+        Args:
+            keys: Cache keys, one per input.
+            model_id: Id of the model producing the vectors.
+            kind: What the vectors represent (e.g. `image_vector`).
+            compute: Called once with the indices of the missing keys, must
+                return one vector per index. It is not called on a full hit.
+        """
+        vectors = [self.get_vector(key, model_id, kind) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            for i, vector in zip(missing, compute(missing)):
+                self.put_vector(keys[i], model_id, kind, vector)
+                vectors[i] = np.asarray(vector, dtype=np.float32).reshape(-1)
+        return vectors
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection.execute(
+                "SELECT COUNT(*) FROM entries",
+            ).fetchone()[0]
+        return {"entries": entries, "bytes": self._size, "max_bytes": self.max_bytes}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
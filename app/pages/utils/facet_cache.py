@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from collections import defaultdict
+from collections.abc import Callable
+
+from cachetools import TTLCache
+
+DEFAULT_TTL = 60.0
+DEFAULT_MAXSIZE = 256
+
+
+class FacetCache:
+    """
+    In-process TTL cache of facet aggregations.
+
+    Entries are keyed by index, fields, size and filters. Every write through
+    this process (index creation and deletion, migrations and bulk flushes)
+    invalidates the entries of that index, the TTL bounds how stale counts
+    get when another process writes to it.
+    """
+
+    def __init__(self, ttl: float | None = None, maxsize: int = DEFAULT_MAXSIZE):
+        if ttl is None:
+            ttl = float(os.environ.get("NOSTALGIA_FACET_CACHE_TTL", DEFAULT_TTL))
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        # Bumped on invalidation, so a result computed before it is never stored
+        self._generations: defaultdict[str, int] = defaultdict(int)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(fields, filters, size) -> str:
+        return json.dumps([sorted(fields), filters, size], sort_keys=True, default=str)
+
+    def get_or_compute(
+        self,
+        index_name: str,
+        key: str,
+        compute: Callable[[], dict],
+    ) -> dict:
+        with self._lock:
+            generation = self._generations[index_name]
+            facets = self._cache.get((index_name, generation, key))
+            if facets is not None:
+                self.hits += 1
+                return facets
+            self.misses += 1
+        facets = compute()
+        with self._lock:
+            if self._generations[index_name] == generation:
+                self._cache[(index_name, generation, key)] = facets
+        return facets
+
+    def invalidate(self, index_name: str):
+        with self._lock:
+            self._generations[index_name] += 1
+            self.invalidations += 1
+            for key in [key for key in self._cache if key[0] == index_name]:
+                del self._cache[key]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._cache),
+                "ttl": self._cache.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = self.invalidations = 0
+
+
+_FACET_CACHE: FacetCache | None = None
+_FACET_CACHE_LOCK = threading.Lock()
+
+
+def get_facet_cache():
+    """Process-wide facet cache, its TTL comes from `NOSTALGIA_FACET_CACHE_TTL` in seconds."""
+    global _FACET_CACHE
+    with _FACET_CACHE_LOCK:
+        if _FACET_CACHE is None:
+            _FACET_CACHE = FacetCache()
+        return _FACET_CACHE
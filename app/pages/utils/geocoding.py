@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import threading
+
+import pycountry
+import reverse_geocoder as rg
+from cachetools import LRUCache
+
+# Three decimals are ~100 meters, well below the spacing of the places in the dataset
+COORDINATE_PRECISION = 3
+DEFAULT_MAX_ENTRIES = 100_000
+
+
+class GeocodingService:
+    """
+    Batched, memoized reverse geocoding.
+
+    A single single-process KD-tree is loaded on first use and every batch of
+    coordinates is resolved with one query on it. Results are memoized on the
+    rounded coordinates and the country lookup is a precomputed dict instead of
+    a `pycountry` search per call.
+    """
+
+    def __init__(
+        self,
+        precision: int = COORDINATE_PRECISION,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        self.precision = precision
+        self._lock = threading.Lock()
+        self._memo: LRUCache = LRUCache(maxsize=max_entries)
+        self._geocoder = None
+        self._countries: dict = {}
+
+    def _load(self):
+        if self._geocoder is None:
+            self._countries = {
+                country.alpha_2: country for country in pycountry.countries
+            }
+            self._geocoder = rg.RGeocoder(mode=1, verbose=False)
+        return self._geocoder
+
+    def _key(self, coordinates):
+        latitude, longitude = coordinates
+        return (
+            round(float(latitude), self.precision),
+            round(float(longitude), self.precision),
+        )
+
+    def lookup_many(self, coordinates):
+        """
+        Resolve a list of (latitude, longitude) tuples.
+
+        Returns:
+            One dict per coordinate with the `reverse_geocoder` fields (`name`,
+            `admin1`, `admin2`, `cc`, ...) and `country` set to the `pycountry`
+            entry (None when the code is unknown).
+        """
+        keys = [self._key(coordinate) for coordinate in coordinates]
+        with self._lock:
+            found = {key: self._memo[key] for key in set(keys) if key in self._memo}
+            missing = [key for key in dict.fromkeys(keys) if key not in found]
+            if missing:
+                locations = self._load().query(missing)
+                for key, location in zip(missing, locations):
+                    location_info = dict(location)
+                    location_info["country"] = self._countries.get(location_info["cc"])
+                    self._memo[key] = location_info
+                    found[key] = location_info
+        return [dict(found[key]) for key in keys]
+
+    def lookup(self, coordinates):
+        return self.lookup_many([coordinates])[0]
+
+
+_SERVICE: GeocodingService | None = None
+_SERVICE_LOCK = threading.Lock()
+
+
+def get_geocoding_service():
+    """Process-wide service, so the KD-tree is only built once per process."""
+    global _SERVICE
+    with _SERVICE_LOCK:
+        if _SERVICE is None:
+            _SERVICE = GeocodingService()
+        return _SERVICE
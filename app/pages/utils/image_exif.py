@@ -1,7 +1,9 @@
 from __future__ import annotations
 
-import pycountry
-import reverse_geocoder as rg
+import datetime
+
+from pages.utils.geocoding import get_geocoding_service
+from pages.utils.metrics import instrumented
 from PIL import Image
 from PIL.ExifTags import GPSTAGS
 from PIL.ExifTags import TAGS
@@ -29,13 +31,18 @@ def exif_to_dict(gps_info):
     return gps_data
 
 
+@instrumented("image_exif.geocode")
 def get_location_info(coordinates):
-    location_info = rg.search(coordinates)[0]
-    location_info["country"] = pycountry.countries.get(alpha_2=location_info["cc"])
-    return location_info
+    return get_geocoding_service().lookup(coordinates)
 
 
-def coordinates_to_country_data(gps_info):
+@instrumented("image_exif.geocode_batch")
+def get_locations_info(coordinates):
+    """Batched `get_location_info`, resolves every coordinate in a single query."""
+    return get_geocoding_service().lookup_many(coordinates)
+
+
+def gps_info_to_coordinates(gps_info):
     gps_info = exif_to_dict(gps_info)
     gps_latitude = gps_info["GPSLatitude"]
     gps_latitude_ref = gps_info["GPSLatitudeRef"]
@@ -46,7 +53,11 @@ def coordinates_to_country_data(gps_info):
         gps_longitude,
         gps_longitude_ref,
     )
-    coordinates = (decimal_latitude, decimal_longitude)
+    return (float(decimal_latitude), float(decimal_longitude))
+
+
+def coordinates_to_country_data(gps_info):
+    coordinates = gps_info_to_coordinates(gps_info)
     return get_location_info(coordinates)
 
 
@@ -79,3 +90,25 @@ def get_exif_ifd(exif):
             break
     info = exif.get_ifd(key)
     return {TAGS.get(key, key): value for key, value in info.items()}
+
+
+@instrumented("image_exif.extract")
+def extract_exif_data(image: Image.Image):
+    """
+    Read the capture date and GPS information of an image.
+
+    Returns:
+        Tuple with the date in `%Y-%m-%dT%H:%M:%SZ` format and the GPS IFD, any
+        of them None when missing or unreadable.
+    """
+    try:
+        exif_data = image.getexif()
+        gps_info = get_geo(exif_data)
+        exif_info = get_exif_ifd(exif_data)
+        date = exif_info["DateTimeOriginal"]
+        if date:
+            date_obj = datetime.datetime.strptime(date, "%Y:%m:%d %H:%M:%S")
+            date = date_obj.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return date, gps_info
+    except Exception:
+        return None, None
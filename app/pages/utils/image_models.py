@@ -1,72 +1,243 @@
 # pip install accelerate
 from __future__ import annotations
 
+import copy
+import functools
+import logging
 import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-import clip
-import requests
-import torch
-from huggingface_hub import login
+import numpy as np
+from pages.utils.metrics import instrumented
+from pages.utils.metrics import observe_stage
+from pages.utils.model_registry import get_model_registry
+from pages.utils.startup import lazy_import
 from PIL import Image
-from transformers import AutoProcessor
-from transformers import Gemma3ForConditionalGeneration
 
-HF_TOKEN = os.environ.get("HF_TOKEN")
-assert HF_TOKEN is not None
-try:
-    login(os.environ.get("HF_TOKEN"))
-except requests.exceptions.ConnectionError:
-    pass
+LOGGER = logging.getLogger()
 
 GEMMA_MODEL_ID = "google/gemma-3-4b-it"
 CLIP_MODEL_ID = "ViT-B/32"
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+CLIP_BATCH_SIZE = int(os.environ.get("CLIP_BATCH_SIZE", 32))
+CLIP_TEXT_BATCH_SIZE = int(os.environ.get("CLIP_TEXT_BATCH_SIZE", 256))
+CLIP_PREPROCESS_WORKERS = int(
+    os.environ.get("CLIP_PREPROCESS_WORKERS", min(8, os.cpu_count() or 1)),
+)
+# eager runs the fp32/fp16 model as is, int8 and torchscript are CPU-only backends
+CLIP_BACKENDS = ("eager", "int8", "torchscript")
+CLIP_NUM_THREADS = int(os.environ.get("CLIP_NUM_THREADS", 0))
+# Reuse the KV cache of the constant captioning prompt across images
+GEMMA_PREFIX_CACHE = os.environ.get("GEMMA_PREFIX_CACHE", "1") == "1"
+GEMMA_BATCH_SIZE = int(os.environ.get("GEMMA_BATCH_SIZE", 4))
+# Small model drafting the captions for assisted decoding, e.g. google/gemma-3-1b-it
+GEMMA_DRAFT_MODEL_ID = os.environ.get("GEMMA_DRAFT_MODEL_ID") or None
+# Resolve the models from the local cache only, without any network call
+OFFLINE = os.environ.get("NOSTALGIA_OFFLINE", "0") == "1"
+if OFFLINE:
+    # Read by huggingface_hub and transformers when they are imported
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
 
 
-def load_clip_model(model_id=None):
+def _patch_torch(torch):
+    # TODO: find a better way? It is only a warning but disturbs me
+    # https://github.com/VikParuchuri/marker/issues/442
+    torch.classes.__path__ = []
+
+
+# The ML stacks are only imported when a model is loaded
+torch = lazy_import("torch", on_import=_patch_torch)
+clip = lazy_import("clip")
+transformers = lazy_import("transformers")
+
+
+@functools.cache
+def get_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+_HF_LOGIN_LOCK = threading.Lock()
+_HF_LOGGED_IN = False
+
+
+def ensure_hf_login():
+    """Log in to the Hugging Face Hub with `HF_TOKEN` once, before loading a gated model."""
+    global _HF_LOGGED_IN
+    with _HF_LOGIN_LOCK:
+        if _HF_LOGGED_IN or OFFLINE:
+            return
+        token = os.environ.get("HF_TOKEN")
+        if token is None:
+            LOGGER.warning("HF_TOKEN is not set, gated models can't be downloaded")
+            return
+        import requests
+        from huggingface_hub import login
+
+        try:
+            login(token)
+        except requests.exceptions.ConnectionError:
+            LOGGER.warning(
+                "Unable to reach the Hugging Face Hub, using the local cache",
+            )
+        _HF_LOGGED_IN = True
+
+
+def get_clip_backend(backend=None):
+    backend = backend or os.environ.get("CLIP_BACKEND", "eager")
+    if backend not in CLIP_BACKENDS:
+        raise ValueError(
+            f"Unknown CLIP backend {backend!r}, expected one of {CLIP_BACKENDS}",
+        )
+    # The default backend doesn't need torch to be imported to be resolved
+    if backend != "eager" and get_device() != "cpu":
+        LOGGER.warning(
+            "The %s CLIP backend is CPU-only, using eager on %s",
+            backend,
+            get_device(),
+        )
+        return "eager"
+    return backend
+
+
+@functools.cache
+def get_clip_cache_id():
+    """Model id under which CLIP vectors are cached, quantized backends are cached apart."""
+    backend = get_clip_backend()
+    return CLIP_MODEL_ID if backend == "eager" else f"{CLIP_MODEL_ID}:{backend}"
+
+
+def __getattr__(name):
+    # Resolved on access, so importing the module doesn't import torch
+    if name == "DEVICE":
+        return get_device()
+    if name == "CLIP_CACHE_ID":
+        return get_clip_cache_id()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@instrumented("image_models.load_clip")
+def load_clip_model(model_id=None, backend=None):
     model_id = model_id if model_id else CLIP_MODEL_ID
-    model, preprocess = clip.load(model_id, device=DEVICE)
+    backend = get_clip_backend(backend)
+    if CLIP_NUM_THREADS:
+        torch.set_num_threads(CLIP_NUM_THREADS)
+    if backend == "torchscript":
+        model, preprocess = clip.load(model_id, device=get_device(), jit=True)
+    else:
+        model, preprocess = clip.load(model_id, device=get_device())
+    if backend == "int8":
+        # Only the MLP projections are quantized, the attention out_proj is a
+        # NonDynamicallyQuantizableLinear and its in_proj a raw parameter
+        model = torch.ao.quantization.quantize_dynamic(
+            model,
+            {torch.nn.Linear},
+            dtype=torch.qint8,
+        )
+    model.eval()
     return model, preprocess
 
 
 def generate_image_vector(image, model, preprocess):
-    image = preprocess(image).unsqueeze(0).to(DEVICE)
-    image_features = model.encode_image(image)
+    image = preprocess(image).unsqueeze(0).to(get_device())
+    with torch.inference_mode():
+        image_features = model.encode_image(image)
     return image_features
 
 
 def generate_text_vector(texts, model):
     # TODO: Maybe we should store a list of dense vectors for each phrase and avoid
     # information loss due to truncation
-    texts_tokens = clip.tokenize(texts, truncate=True).to(DEVICE)
-    texts_features = model.encode_text(texts_tokens)
+    texts_tokens = clip.tokenize(texts, truncate=True).to(get_device())
+    with torch.inference_mode():
+        texts_features = model.encode_text(texts_tokens)
     return texts_features
 
 
-def load_gemma_model(model_id=None):
-    model_id = model_id if model_id else GEMMA_MODEL_ID
-    model = Gemma3ForConditionalGeneration.from_pretrained(
-        model_id,
-        device_map=DEVICE,
-        torch_dtype=torch.bfloat16,
-    ).eval()
-    processor = AutoProcessor.from_pretrained(GEMMA_MODEL_ID, use_fast=True)
-    return model, processor
+def _to_normalized_array(features):
+    features = features.float()
+    features = features / features.norm(dim=-1, keepdim=True)
+    return features.cpu().numpy()
 
 
-def generate_image_description(
-    image: Image,
+def _fill_output(output, start, vectors, total):
+    if output is None:
+        output = np.empty((total, vectors.shape[-1]), dtype=np.float32)
+    output[start : start + len(vectors)] = vectors
+    return output
+
+
+@instrumented("image_models.clip_images")
+def encode_images(
+    images,
     model,
-    processor,
-    language: str = "spanish",
-):
-    messages = [
-        {
-            "role": "system",
-            "content": [
-                {
-                    "type": "text",
-                    "text": """
+    preprocess,
+    batch_size: int | None = None,
+    num_workers: int | None = None,
+) -> np.ndarray:
+    """
+    Encode a list of PIL images with CLIP in batches.
+
+    Preprocessing runs in a thread pool and the next chunk is prepared while
+    the current one goes through the model.
+
+    Returns:
+        Contiguous float32 array of shape (len(images), dims) with L2 normalized rows.
+    """
+    batch_size = batch_size or CLIP_BATCH_SIZE
+    num_workers = num_workers or CLIP_PREPROCESS_WORKERS
+    if not images:
+        return np.empty((0, 0), dtype=np.float32)
+    starts = list(range(0, len(images), batch_size))
+    output = None
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+
+        def submit(start):
+            return [
+                pool.submit(preprocess, image)
+                for image in images[start : start + batch_size]
+            ]
+
+        pending = submit(starts[0])
+        for i, start in enumerate(starts):
+            batch = torch.stack([future.result() for future in pending])
+            if i + 1 < len(starts):
+                pending = submit(starts[i + 1])
+            with torch.inference_mode():
+                features = model.encode_image(batch.to(get_device()))
+            output = _fill_output(
+                output,
+                start,
+                _to_normalized_array(features),
+                len(images),
+            )
+    return output
+
+
+@instrumented("image_models.clip_texts")
+def encode_texts(texts, model, batch_size: int | None = None) -> np.ndarray:
+    """
+    Encode a list of texts with CLIP in batches.
+
+    Returns:
+        Contiguous float32 array of shape (len(texts), dims) with L2 normalized rows.
+    """
+    batch_size = batch_size or CLIP_TEXT_BATCH_SIZE
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    output = None
+    for start in range(0, len(texts), batch_size):
+        tokens = clip.tokenize(texts[start : start + batch_size], truncate=True)
+        with torch.inference_mode():
+            features = model.encode_text(tokens.to(get_device()))
+        output = _fill_output(output, start, _to_normalized_array(features), len(texts))
+    return output
+
+
+CAPTION_SYSTEM_PROMPT = """
 Role: You are an expert visual analyst and caption writer.
 Audience: Your captions will be used by people searching for images or recalling personal memories.
 Scenario: You receive an image and need to describe it clearly and efficiently.
@@ -80,7 +251,57 @@ Expectation:
 - Avoid subjective impressions or storytelling.
 - Avoid any meta-description or references to the image itself.
 Format: Only include one to two factual and descriptive sentences per image. Do not include anything else.
-""",
+"""
+
+
+@instrumented("image_models.load_gemma")
+def load_gemma_model(model_id=None):
+    model_id = model_id if model_id else GEMMA_MODEL_ID
+    ensure_hf_login()
+    model = transformers.Gemma3ForConditionalGeneration.from_pretrained(
+        model_id,
+        device_map=get_device(),
+        torch_dtype=torch.bfloat16,
+        local_files_only=OFFLINE,
+    ).eval()
+    processor = transformers.AutoProcessor.from_pretrained(
+        GEMMA_MODEL_ID,
+        use_fast=True,
+        local_files_only=OFFLINE,
+    )
+    # Left padding keeps the end of every prompt of a batch at the same position
+    processor.tokenizer.padding_side = "left"
+    return model, processor
+
+
+@instrumented("image_models.load_gemma_draft")
+def load_gemma_draft_model(model_id=None):
+    """Load the draft model and its tokenizer used for assisted decoding."""
+    model_id = model_id if model_id else GEMMA_DRAFT_MODEL_ID
+    if not model_id:
+        raise ValueError("No draft model, set GEMMA_DRAFT_MODEL_ID.")
+    ensure_hf_login()
+    model = transformers.AutoModelForCausalLM.from_pretrained(
+        model_id,
+        device_map=get_device(),
+        torch_dtype=torch.bfloat16,
+        local_files_only=OFFLINE,
+    ).eval()
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        model_id,
+        local_files_only=OFFLINE,
+    )
+    return model, tokenizer
+
+
+def build_caption_messages(image: Image, language: str = "spanish"):
+    return [
+        {
+            "role": "system",
+            "content": [
+                {
+                    "type": "text",
+                    "text": CAPTION_SYSTEM_PROMPT,
                 },
             ],
         },
@@ -96,32 +317,367 @@ Format: Only include one to two factual and descriptive sentences per image. Do
         },
     ]
 
-    inputs = processor.apply_chat_template(
-        messages,
+
+class PromptPrefix:
+    """Attention KV cache of the constant part of the captioning prompt."""
+
+    def __init__(self, input_ids, cache):
+        self.input_ids = input_ids
+        self.cache = cache
+
+    @property
+    def length(self):
+        return self.input_ids.shape[-1]
+
+    def matches(self, input_ids):
+        if input_ids.shape[-1] <= self.length + 1:
+            return False
+        prefix_ids = self.input_ids.expand(input_ids.shape[0], -1)
+        return torch.equal(input_ids[:, : self.length], prefix_ids)
+
+
+# One prefix per loaded model and language, dropped together with the model
+_PROMPT_PREFIXES: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_PROMPT_PREFIXES_LOCK = threading.Lock()
+
+
+def _image_token_mask(model, input_ids):
+    return input_ids == model.config.image_token_index
+
+
+def get_prompt_prefix(model, inputs, language: str = "spanish"):
+    """
+    Return the cached prompt prefix of `model` for `language`, prefilling it once.
+
+    The prefix is every token before the first image token, i.e. the system
+    prompt and the instruction, which are the same for every photo.
+    """
+    with _PROMPT_PREFIXES_LOCK:
+        prefixes = _PROMPT_PREFIXES.setdefault(model, {})
+        if language in prefixes:
+            return prefixes[language]
+        image_positions = _image_token_mask(model, inputs["input_ids"][0]).nonzero()
+        if len(image_positions) == 0:
+            return None
+        # Stop before the image, including the start of image token
+        length = int(image_positions[0]) - 1
+        input_ids = inputs["input_ids"][:1, :length]
+        cache = transformers.DynamicCache()
+        model_inputs = model.prepare_inputs_for_generation(
+            input_ids,
+            past_key_values=cache,
+            attention_mask=torch.ones_like(input_ids),
+            cache_position=torch.arange(length, device=input_ids.device),
+            use_cache=True,
+        )
+        with torch.inference_mode():
+            model(**model_inputs)
+        prefixes[language] = PromptPrefix(input_ids, cache)
+        return prefixes[language]
+
+
+def _suffix_attention_mask(image_tokens, start, dtype):
+    """
+    4D additive mask for the queries from `start` on, over every previous token.
+
+    Text tokens attend causally while image tokens also attend to every other
+    token of the image, as Gemma 3 does when it prefills the whole prompt.
+    """
+    batch_size, length = image_tokens.shape
+    device = image_tokens.device
+    query_positions = torch.arange(start, length, device=device)
+    key_positions = torch.arange(length, device=device)
+    allowed = key_positions[None, :] <= query_positions[:, None]
+    allowed = allowed[None].expand(batch_size, -1, -1)
+    allowed = allowed | (image_tokens[:, start:, None] & image_tokens[:, None, :])
+    mask = torch.zeros(
+        (batch_size, 1, length - start, length),
+        dtype=dtype,
+        device=device,
+    )
+    return mask.masked_fill(~allowed[:, None], torch.finfo(dtype).min)
+
+
+def _prefill_from_prefix(model, inputs, prefix: PromptPrefix):
+    """
+    Extend a copy of the prefix cache with the rest of the prompt but its last token.
+
+    `generate` then only has to process that last token, so the constant part
+    of the prompt is never prefilled again.
+    """
+    input_ids = inputs["input_ids"]
+    batch_size, length = input_ids.shape
+    cache = copy.deepcopy(prefix.cache)
+    if batch_size > 1:
+        cache.batch_repeat_interleave(batch_size)
+    model_inputs = model.prepare_inputs_for_generation(
+        input_ids[:, : length - 1],
+        past_key_values=cache,
+        attention_mask=inputs["attention_mask"][:, : length - 1],
+        cache_position=torch.arange(prefix.length, length - 1, device=input_ids.device),
+        use_cache=True,
+        logits_to_keep=1,
+    )
+    model_inputs["pixel_values"] = inputs["pixel_values"]
+    model_inputs["attention_mask"] = _suffix_attention_mask(
+        _image_token_mask(model, input_ids[:, : length - 1]),
+        prefix.length,
+        model.dtype,
+    )
+    model_inputs.pop("token_type_ids", None)
+    with torch.inference_mode():
+        model(**model_inputs)
+    return cache
+
+
+def _caption_inputs(images, model, processor, language):
+    return processor.apply_chat_template(
+        [build_caption_messages(image, language) for image in images],
         add_generation_prompt=True,
         tokenize=True,
         return_dict=True,
         return_tensors="pt",
+        padding=True,
     ).to(model.device, dtype=torch.bfloat16)
 
-    input_len = inputs["input_ids"].shape[-1]
 
-    with torch.inference_mode():
-        generation = model.generate(
-            **inputs,
-            max_new_tokens=100,
-            do_sample=False,
-            top_p=None,
-            top_k=None,
+@contextmanager
+def _resolve_assistant(assistant):
+    """Hold the `gemma_draft` model of the registry by default, if one is configured."""
+    if assistant is None and GEMMA_DRAFT_MODEL_ID:
+        with get_model_registry().use("gemma_draft") as draft:
+            yield draft
+    else:
+        yield assistant or None
+
+
+def _caption_generate_kwargs(
+    model,
+    processor,
+    inputs,
+    language,
+    use_prefix_cache,
+    assistant=None,
+):
+    """Arguments of `model.generate`, reusing the prompt prefix cache when possible."""
+    kwargs = {
+        **inputs,
+        "max_new_tokens": 100,
+        "do_sample": False,
+        "top_p": None,
+        "top_k": None,
+    }
+    if assistant:
+        # The text-only draft can't embed the image tokens. Universal assisted decoding
+        # re-tokenizes the prompt for it without the special tokens. Greedy verification
+        # keeps the output of the target model unchanged.
+        draft_model, draft_tokenizer = assistant
+        kwargs["assistant_model"] = draft_model
+        kwargs["tokenizer"] = processor.tokenizer
+        kwargs["assistant_tokenizer"] = draft_tokenizer
+        return kwargs
+    if use_prefix_cache is None:
+        use_prefix_cache = GEMMA_PREFIX_CACHE
+    # Padded batches don't share the prefix positions, they go through the full prefill
+    if not use_prefix_cache or not bool(inputs["attention_mask"].all()):
+        return kwargs
+    prefix = get_prompt_prefix(model, inputs, language)
+    if prefix is None or not prefix.matches(inputs["input_ids"]):
+        return kwargs
+    kwargs["past_key_values"] = _prefill_from_prefix(model, inputs, prefix)
+    # The image is already in the cache
+    kwargs.pop("pixel_values", None)
+    kwargs.pop("token_type_ids", None)
+    return kwargs
+
+
+@instrumented("image_models.caption")
+def generate_image_descriptions(
+    images,
+    model,
+    processor,
+    language: str = "spanish",
+    use_prefix_cache: bool | None = None,
+    batch_size: int | None = None,
+    assistant=None,
+):
+    """
+    Caption images with one `generate` call per batch of `batch_size` images.
+
+    The KV cache of the constant prompt prefix (system prompt and instruction)
+    is computed once per model and language and reused by every call.
+
+    `assistant` is a (draft model, tokenizer) pair for assisted decoding,
+    by default the one of `GEMMA_DRAFT_MODEL_ID` if set, False disables it.
+    Assisted decoding only supports one image per call and doesn't use the
+    prefix cache.
+    """
+    with _resolve_assistant(assistant) as assistant:
+        batch_size = 1 if assistant else batch_size or GEMMA_BATCH_SIZE
+        descriptions = []
+        for start in range(0, len(images), batch_size):
+            inputs = _caption_inputs(
+                images[start : start + batch_size],
+                model,
+                processor,
+                language,
+            )
+            input_len = inputs["input_ids"].shape[-1]
+
+            with torch.inference_mode():
+                generation = model.generate(
+                    **_caption_generate_kwargs(
+                        model,
+                        processor,
+                        inputs,
+                        language,
+                        use_prefix_cache,
+                        assistant,
+                    ),
+                )
+                generation = generation[:, input_len:]
+
+            descriptions += processor.batch_decode(
+                generation,
+                skip_special_tokens=True,
+            )
+    return descriptions
+
+
+def generate_image_description(
+    image: Image,
+    model,
+    processor,
+    language: str = "spanish",
+    use_prefix_cache: bool | None = None,
+    assistant=None,
+):
+    return generate_image_descriptions(
+        [image],
+        model,
+        processor,
+        language=language,
+        use_prefix_cache=use_prefix_cache,
+        assistant=assistant,
+    )[0]
+
+
+@functools.cache
+def _cancel_criteria_class():
+    # Defined on first use, subclassing needs transformers to be imported
+    class CancelCriteria(transformers.StoppingCriteria):
+        """Stop generating as soon as `event` is set."""
+
+        def __init__(self, event: threading.Event):
+            self.event = event
+
+        def __call__(self, input_ids, scores, **kwargs):
+            return torch.full(
+                (input_ids.shape[0],),
+                self.event.is_set(),
+                dtype=torch.bool,
+                device=input_ids.device,
+            )
+
+    return CancelCriteria
+
+
+def cancel_criteria(event: threading.Event):
+    return _cancel_criteria_class()(event)
+
+
+def stream_image_description(
+    image: Image,
+    model,
+    processor,
+    language: str = "spanish",
+    cancel_event: threading.Event | None = None,
+    use_prefix_cache: bool | None = None,
+    assistant=None,
+):
+    """
+    Yield the caption of `image` as text chunks while it is being generated.
+
+    `generate` runs on a worker thread. Setting `cancel_event`, or closing the
+    generator before it is exhausted, stops the generation at the next token.
+    An error of the worker is raised once the streamed text has been consumed.
+    """
+    # The draft model is held until the generation thread is joined
+    with _resolve_assistant(assistant) as assistant:
+        cancel_event = cancel_event or threading.Event()
+        inputs = _caption_inputs([image], model, processor, language)
+        streamer = transformers.TextIteratorStreamer(
+            processor.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+        )
+        kwargs = _caption_generate_kwargs(
+            model,
+            processor,
+            inputs,
+            language,
+            use_prefix_cache,
+            assistant,
+        )
+        kwargs["streamer"] = streamer
+        kwargs["stopping_criteria"] = transformers.StoppingCriteriaList(
+            [cancel_criteria(cancel_event)],
         )
-        generation = generation[0][input_len:]
 
-    decoded = processor.decode(generation, skip_special_tokens=True)
-    return decoded
+        errors: list[Exception] = []
+
+        def generate():
+            try:
+                with torch.inference_mode():
+                    model.generate(**kwargs)
+            except Exception as e:
+                errors.append(e)
+                # Unblock the consumer, the streamer would wait forever otherwise
+                streamer.end()
+
+        thread = threading.Thread(target=generate, name="caption-stream", daemon=True)
+        start = time.perf_counter()
+        first_token = True
+        status = "cancelled"
+        thread.start()
+        try:
+            for text in streamer:
+                if cancel_event.is_set():
+                    break
+                if text:
+                    if first_token:
+                        observe_stage(
+                            "image_models.caption_stream.first_token",
+                            time.perf_counter() - start,
+                        )
+                        first_token = False
+                    yield text
+            else:
+                status = "ok"
+        finally:
+            cancel_event.set()
+            thread.join()
+            observe_stage(
+                "image_models.caption_stream",
+                time.perf_counter() - start,
+                status="error" if errors else status,
+            )
+        if errors:
+            raise errors[0]
 
 
 if __name__ == "__main__":
     example_image = "example-image.jpg"
     image = Image.open(example_image)
     model, processor = load_gemma_model()
-    print(generate_image_description(image, model, processor))
+    for use_prefix_cache in [False, True, True]:
+        start = time.perf_counter()
+        description = generate_image_description(
+            image,
+            model,
+            processor,
+            use_prefix_cache=use_prefix_cache,
+        )
+        print(
+            f"prefix cache={use_prefix_cache} {time.perf_counter() - start:.2f}s: {description}",
+        )
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import base64
+import os
+from io import BytesIO
+
+import numpy as np
+import requests
+from PIL import Image
+
+DEFAULT_TIMEOUT = 300
+# Neither CLIP (224px) nor Gemma (896px) look at more pixels than this
+TRANSPORT_IMAGE_SIZE = 1024
+
+
+def encode_array(array: np.ndarray):
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    return {
+        "dtype": "float32",
+        "shape": list(array.shape),
+        "data": base64.b64encode(array.tobytes()).decode("ascii"),
+    }
+
+
+def decode_array(payload: dict) -> np.ndarray:
+    data = base64.b64decode(payload["data"])
+    return np.frombuffer(data, dtype=payload["dtype"]).reshape(payload["shape"])
+
+
+def encode_image(image: Image.Image):
+    image = image.convert("RGB")
+    if max(image.size) > TRANSPORT_IMAGE_SIZE:
+        image = image.copy()
+        image.thumbnail((TRANSPORT_IMAGE_SIZE, TRANSPORT_IMAGE_SIZE))
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=95)
+    return base64.b64encode(buffered.getvalue()).decode("ascii")
+
+
+def decode_image(data: str) -> Image.Image:
+    image = Image.open(BytesIO(base64.b64decode(data)))
+    image.load()
+    return image
+
+
+class InferenceClient:
+    """Thin HTTP client for `pages.utils.inference_server`."""
+
+    def __init__(self, url: str, timeout: float = DEFAULT_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _post(self, path: str, payload: dict):
+        response = self.session.post(
+            f"{self.url}{path}",
+            json=payload,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def health(self):
+        response = self.session.get(f"{self.url}/health", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def encode_texts(self, texts) -> np.ndarray:
+        return decode_array(
+            self._post("/encode/text", {"texts": list(texts)})["vectors"],
+        )
+
+    def encode_images(self, images) -> np.ndarray:
+        payload = {"images": [encode_image(image) for image in images]}
+        return decode_array(self._post("/encode/image", payload)["vectors"])
+
+    def captions(self, images, language: str = "spanish") -> list[str]:
+        payload = {
+            "images": [encode_image(image) for image in images],
+            "language": language,
+        }
+        return self._post("/caption", payload)["captions"]
+
+    def caption(self, image: Image.Image, language: str = "spanish") -> str:
+        return self.captions([image], language)[0]
+
+
+def get_inference_client():
+    """Client for `NOSTALGIA_INFERENCE_URL`, or None to run the models in-process."""
+    url = os.environ.get("NOSTALGIA_INFERENCE_URL")
+    return InferenceClient(url) if url else None
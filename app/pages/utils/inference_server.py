@@ -0,0 +1,252 @@
+"""
+Local inference service that owns the CLIP and Gemma models.
+
+Concurrent requests from every Streamlit session are coalesced into
+micro-batches: a batch is dispatched as soon as it is full or `max_wait`
+seconds after its first item arrived. Start it from the `app` directory and
+point the pages to it with `NOSTALGIA_INFERENCE_URL=http://127.0.0.1:8765`:
+
+    python -m pages.utils.inference_server --port 8765
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from pages.utils import metrics
+from pages.utils.inference_client import decode_image
+from pages.utils.inference_client import encode_array
+from pages.utils.model_registry import get_model_registry
+
+LOGGER = logging.getLogger()
+
+POST_PATHS = ("/encode/text", "/encode/image", "/caption")
+
+
+class MicroBatcher:
+    """
+    Coalesce single items submitted from many threads into batches.
+
+    `fn` receives a list of items and must return one result per item.
+    """
+
+    def __init__(self, name, fn, max_batch_size: int = 32, max_wait: float = 0.01):
+        self.name = name
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        future: Future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def map(self, items):
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            try:
+                results = self.fn(items)
+            except Exception as e:
+                LOGGER.exception("Batch of %s %s items failed", len(items), self.name)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(items)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "queued": self._queue.qsize(),
+        }
+
+
+class InferenceService:
+    def __init__(
+        self,
+        max_batch_size: int = 32,
+        max_wait: float = 0.01,
+        caption_batch_size: int = 4,
+    ):
+        self.models = get_model_registry()
+        # CLIP serves every search, Gemma is loaded on the first caption request
+        self.models.get("clip")
+        self.text_batcher = MicroBatcher(
+            "text",
+            self._encode_texts,
+            max_batch_size,
+            max_wait,
+        )
+        self.image_batcher = MicroBatcher(
+            "image",
+            self._encode_images,
+            max_batch_size,
+            max_wait,
+        )
+        self.caption_batcher = MicroBatcher(
+            "caption",
+            self._caption,
+            caption_batch_size,
+            max_wait,
+        )
+
+    def _encode_texts(self, texts):
+        from pages.utils.image_models import encode_texts
+
+        with self.models.use("clip") as (model, _):
+            return list(encode_texts(texts, model))
+
+    def _encode_images(self, images):
+        from pages.utils.image_models import encode_images
+
+        with self.models.use("clip") as (model, preprocess):
+            return list(encode_images(images, model, preprocess))
+
+    def _caption(self, items):
+        from pages.utils.image_models import generate_image_descriptions
+
+        # Prompts only share their cached prefix within the same language
+        by_language: dict = {}
+        for i, (image, language) in enumerate(items):
+            by_language.setdefault(language, []).append(i)
+        captions = [None] * len(items)
+        with self.models.use("gemma") as (model, processor):
+            for language, indices in by_language.items():
+                descriptions = generate_image_descriptions(
+                    [items[i][0] for i in indices],
+                    model,
+                    processor,
+                    language=language,
+                    batch_size=len(indices),
+                )
+                for i, description in zip(indices, descriptions):
+                    captions[i] = description
+        return captions
+
+    def stats(self):
+        return {
+            "models": self.models.stats(),
+            "text": self.text_batcher.stats(),
+            "image": self.image_batcher.stats(),
+            "caption": self.caption_batcher.stats(),
+        }
+
+
+def make_handler(service: InferenceService):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, payload, status=200):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(service.stats())
+            elif self.path == "/metrics":
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send_json({"error": f"Unknown path {self.path}"}, status=404)
+
+        def do_POST(self):
+            # Only known paths become metric labels, any other URL would add a series
+            if self.path not in POST_PATHS:
+                self._send_json({"error": f"Unknown path {self.path}"}, status=404)
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            metrics.observe_payload(f"inference{self.path}", length, direction="in")
+            try:
+                payload = json.loads(self.rfile.read(length))
+                if self.path == "/encode/text":
+                    vectors = service.text_batcher.map(payload["texts"])
+                    self._send_json({"vectors": encode_array(vectors)})
+                elif self.path == "/encode/image":
+                    images = [decode_image(data) for data in payload["images"]]
+                    vectors = service.image_batcher.map(images)
+                    self._send_json({"vectors": encode_array(vectors)})
+                elif self.path == "/caption":
+                    language = payload.get("language", "spanish")
+                    items = [
+                        (decode_image(data), language) for data in payload["images"]
+                    ]
+                    self._send_json({"captions": service.caption_batcher.map(items)})
+            except (KeyError, ValueError) as e:
+                self._send_json({"error": str(e)}, status=400)
+            except Exception as e:
+                LOGGER.exception("Inference request failed")
+                self._send_json({"error": str(e)}, status=500)
+
+        def log_message(self, format, *args):
+            LOGGER.debug(format, *args)
+
+    return Handler
+
+
+def serve(host="127.0.0.1", port=8765, **service_kwargs):
+    service = InferenceService(**service_kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    LOGGER.info("Inference server listening on http://%s:%s", host, port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve the CLIP and Gemma models over HTTP.",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--caption-batch-size", type=int, default=4)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve(
+        args.host,
+        args.port,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        caption_batch_size=args.caption_batch_size,
+    )
@@ -0,0 +1,528 @@
+"""
+Headless ingestion of a photo directory.
+
+The photos go through a pipeline of concurrent stages connected by bounded
+queues, so a slow stage applies backpressure instead of buffering the whole
+library in memory:
+
+    decode + EXIF (process pool) -> geocode -> caption (optional) -> CLIP -> index
+
+Indexed files are appended to a checkpoint so an interrupted run can be resumed.
+Run from the `app` directory:
+
+    python -m pages.utils.ingest ~/Pictures --caption
+"""
+
+from __future__ import annotations
+
+import argparse
+import collections
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+from elasticsearch import Elasticsearch
+from pages.utils import journal
+from pages.utils.blob_store import BlobStore
+from pages.utils.blob_store import hash_bytes
+from pages.utils.bulk import bulk_import_settings
+from pages.utils.bulk import BulkIndexer
+from pages.utils.embedding_cache import EmbeddingCache
+from pages.utils.embedding_cache import image_cache_key
+from pages.utils.embedding_cache import text_cache_key
+from pages.utils.image_exif import extract_exif_data
+from pages.utils.image_exif import get_locations_info
+from pages.utils.image_exif import gps_info_to_coordinates
+from pages.utils.image_models import encode_images
+from pages.utils.image_models import encode_texts
+from pages.utils.image_models import GEMMA_MODEL_ID
+from pages.utils.image_models import generate_image_descriptions
+from pages.utils.image_models import get_clip_cache_id
+from pages.utils.metadata import find_photos
+from pages.utils.model_registry import get_model_registry
+from pages.utils.model_registry import ModelRegistry
+from PIL import Image
+from pillow_heif import register_heif_opener
+
+register_heif_opener()
+
+SCRIPT_PATH = Path(__file__).parent.absolute()
+LOGGER = logging.getLogger()
+
+DEFAULT_CHECKPOINT_DIR = SCRIPT_PATH.parent.parent / "data" / "checkpoints"
+# The models never need more than this, the full size image goes to the blob store
+MODEL_IMAGE_SIZE = 1024
+_DONE = object()
+
+
+def decode_photo(path, blob_root):
+    """Hash, decode and store one photo. Runs in a worker process."""
+    data = Path(path).read_bytes()
+    file_id = hash_bytes(data)
+    with Image.open(BytesIO(data)) as original:
+        date, gps_info = extract_exif_data(original)
+        coordinates = None
+        if gps_info:
+            try:
+                coordinates = gps_info_to_coordinates(gps_info)
+            except (KeyError, TypeError, ZeroDivisionError):
+                LOGGER.warning("Invalid GPS information in %s", path)
+        image = original.convert("RGB")
+    image_ref = BlobStore(blob_root).put(file_id, image)
+    image.thumbnail((MODEL_IMAGE_SIZE, MODEL_IMAGE_SIZE))
+    return {
+        "path": str(path),
+        "file_id": file_id,
+        "image_ref": image_ref,
+        "date": date,
+        "coordinates": coordinates,
+        "image": image,
+        "city": None,
+        "country": None,
+        "generated_description": None,
+    }
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.failed: list[str] = []
+        self._lock = threading.Lock()
+
+    def record(self, processed, seconds, errors=0):
+        with self._lock:
+            self.processed += processed
+            self.errors += errors
+            self.busy += seconds
+
+    def fail(self, paths, seconds=0.0):
+        """Record photos lost by this stage, they are never checkpointed."""
+        with self._lock:
+            self.errors += len(paths)
+            self.failed.extend(paths)
+            self.busy += seconds
+
+    def report(self, elapsed, pending=None):
+        if not elapsed:
+            return f"{self.name:>8}: starting"
+        rate = self.processed / elapsed
+        per_item = self.busy / self.processed * 1000 if self.processed else 0.0
+        line = (
+            f"{self.name:>8}: {self.processed:>7} done {self.errors:>4} errors "
+            f"{rate:>7.1f}/s {per_item:>8.1f} ms/item busy {self.busy / elapsed:>5.0%}"
+        )
+        if pending is not None:
+            line += f" queue {pending:>4}"
+        return line
+
+
+class Checkpoint:
+    """Append-only list of the files already indexed."""
+
+    def __init__(self, path):
+        self.path = Path(path) if path else None
+        self.done = set()
+        if self.path and self.path.exists():
+            self.done = set(self.path.read_text().splitlines())
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def commit(self, keys):
+        if not keys:
+            return
+        self.done.update(keys)
+        if self.path:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a") as f:
+                f.writelines(f"{key}\n" for key in keys)
+
+
+def default_checkpoint_path(root):
+    digest = hashlib.sha256(str(Path(root).resolve()).encode("utf-8")).hexdigest()
+    return DEFAULT_CHECKPOINT_DIR / f"{digest[:16]}.txt"
+
+
+class IngestionPipeline:
+    def __init__(
+        self,
+        es_client: Elasticsearch,
+        index_name: str = "images",
+        blob_store: BlobStore | None = None,
+        embedding_cache: EmbeddingCache | None = None,
+        caption: bool = False,
+        language: str = "spanish",
+        workers: int | None = None,
+        batch_size: int = 32,
+        queue_size: int = 64,
+        max_wait: float = 0.5,
+        checkpoint: Checkpoint | None = None,
+        report_every: float = 10.0,
+        models: ModelRegistry | None = None,
+    ):
+        self.es_client = es_client
+        self.index_name = index_name
+        self.blob_store = blob_store or BlobStore()
+        self.embedding_cache = embedding_cache or EmbeddingCache()
+        self.caption = caption
+        self.language = language
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.checkpoint = checkpoint or Checkpoint(None)
+        self.report_every = report_every
+        self.skipped = 0
+        self.stats = {
+            name: StageStats(name)
+            for name in ["decode", "geocode", "caption", "clip", "index"]
+        }
+        self.models = models or get_model_registry()
+
+    def _take_batch(self, inp: queue.Queue):
+        """Block for one item, then wait up to `max_wait` to fill the batch."""
+        batch = [inp.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size and batch[-1] is not _DONE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(inp.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self, inp: queue.Queue, stats: StageStats):
+        """Fail the items left in `inp` so the upstream stages never block on it."""
+        while (item := inp.get()) is not _DONE:
+            stats.fail([item["path"]])
+
+    def _decode_stage(self, paths, out: queue.Queue):
+        stats = self.stats["decode"]
+        in_flight: collections.deque = collections.deque()
+
+        def drain_one():
+            start, path, future = in_flight.popleft()
+            try:
+                item = future.result()
+            except Exception:
+                LOGGER.exception("Unable to decode %s", path)
+                stats.fail([path], time.perf_counter() - start)
+                return
+            stats.record(1, time.perf_counter() - start)
+            out.put(item)
+
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                for path in paths:
+                    if str(path) in self.checkpoint:
+                        self.skipped += 1
+                        continue
+                    future = pool.submit(
+                        decode_photo,
+                        str(path),
+                        str(self.blob_store.root),
+                    )
+                    in_flight.append((time.perf_counter(), str(path), future))
+                    # Bounded in-flight work, blocks here while downstream is full
+                    if len(in_flight) >= self.queue_size:
+                        drain_one()
+                while in_flight:
+                    drain_one()
+        except Exception:
+            # e.g. a BrokenProcessPool, the photos not submitted yet are left for
+            # the next run since they are not checkpointed
+            LOGGER.exception("Decode stage stopped")
+            while in_flight:
+                drain_one()
+        finally:
+            out.put(_DONE)
+
+    def _batch_stage(self, name, inp: queue.Queue, out: queue.Queue, fn):
+        stats = self.stats[name]
+        done = False
+        try:
+            while not done:
+                batch = self._take_batch(inp)
+                if batch[-1] is _DONE:
+                    done = True
+                    batch = batch[:-1]
+                if not batch:
+                    continue
+                start = time.perf_counter()
+                try:
+                    fn(batch)
+                except Exception:
+                    LOGGER.exception(
+                        "Stage %s failed on a batch of %s photos",
+                        name,
+                        len(batch),
+                    )
+                    stats.fail(
+                        [item["path"] for item in batch],
+                        time.perf_counter() - start,
+                    )
+                    continue
+                stats.record(len(batch), time.perf_counter() - start)
+                for item in batch:
+                    out.put(item)
+        except Exception:
+            LOGGER.exception("Stage %s stopped", name)
+        finally:
+            if not done:
+                self._drain(inp, stats)
+            out.put(_DONE)
+
+    def geocode(self, batch):
+        located = [item for item in batch if item["coordinates"]]
+        locations = get_locations_info([item["coordinates"] for item in located])
+        for item, location in zip(located, locations):
+            item["city"] = location["name"]
+            item["country"] = location["country"].name if location["country"] else None
+
+    def generate_captions(self, batch):
+        kind = f"caption:{self.language}"
+        keys = [image_cache_key(item["file_id"]) for item in batch]
+        descriptions = [
+            self.embedding_cache.get_text(key, GEMMA_MODEL_ID, kind) for key in keys
+        ]
+        missing = [
+            i for i, description in enumerate(descriptions) if description is None
+        ]
+        if missing:
+            with self.models.use("gemma") as (model, processor):
+                generated = generate_image_descriptions(
+                    [batch[i]["image"] for i in missing],
+                    model,
+                    processor,
+                    language=self.language,
+                )
+            for i, description in zip(missing, generated):
+                self.embedding_cache.put_text(
+                    keys[i],
+                    GEMMA_MODEL_ID,
+                    kind,
+                    description,
+                )
+                descriptions[i] = description
+        for item, description in zip(batch, descriptions):
+            item["generated_description"] = description
+
+    def encode(self, batch):
+        def compute_images(missing):
+            with self.models.use("clip") as (model, preprocess):
+                return encode_images(
+                    [batch[i]["image"] for i in missing],
+                    model,
+                    preprocess,
+                )
+
+        image_vectors = self.embedding_cache.get_or_compute_vectors(
+            [image_cache_key(item["file_id"]) for item in batch],
+            get_clip_cache_id(),
+            "image_vector",
+            compute_images,
+        )
+        captioned = [item for item in batch if item["generated_description"]]
+        texts = [item["generated_description"] for item in captioned]
+
+        def compute_texts(missing):
+            with self.models.use("clip") as (model, _):
+                return encode_texts([texts[i] for i in missing], model)
+
+        text_vectors = self.embedding_cache.get_or_compute_vectors(
+            [text_cache_key(text) for text in texts],
+            get_clip_cache_id(),
+            "text_vector",
+            compute_texts,
+        )
+        for item, vector in zip(batch, image_vectors):
+            item["image_vector"] = vector
+            item["generated_description_embedding"] = None
+        for item, vector in zip(captioned, text_vectors):
+            item["generated_description_embedding"] = vector
+
+    def _index_stage(self, inp: queue.Queue, writer: BulkIndexer):
+        stats = self.stats["index"]
+        pending: list[tuple[str, str]] = []
+
+        def fail_pending(start):
+            stats.fail([path for path, _ in pending], time.perf_counter() - start)
+            pending.clear()
+
+        def commit():
+            start = time.perf_counter()
+            try:
+                writer.flush()
+            except Exception:
+                LOGGER.exception("Unable to index a batch of %s photos", len(pending))
+                fail_pending(start)
+                return
+            failed = {failure.id for failure in writer.failures}
+            self.checkpoint.commit([path for path, id in pending if id not in failed])
+            stats.record(0, time.perf_counter() - start)
+            pending.clear()
+
+        done = False
+        try:
+            while True:
+                item = inp.get()
+                if item is _DONE:
+                    done = True
+                    break
+                start = time.perf_counter()
+                try:
+                    payload = journal.Image(
+                        id=item["file_id"],
+                        image_ref=item["image_ref"],
+                        title=Path(item["path"]).name,
+                        city=item["city"],
+                        country=item["country"],
+                        date=item["date"],
+                        generated_description=item["generated_description"],
+                        generated_description_embedding=item[
+                            "generated_description_embedding"
+                        ],
+                        image_vector=item["image_vector"],
+                    ).model_dump()
+                except Exception:
+                    LOGGER.exception("Invalid document for %s", item["path"])
+                    stats.fail([item["path"]], time.perf_counter() - start)
+                    continue
+                pending.append((item["path"], item["file_id"]))
+                try:
+                    # May send the buffer, which holds every pending photo
+                    writer.index(payload, id=item["file_id"])
+                except Exception:
+                    LOGGER.exception(
+                        "Unable to index a batch of %s photos",
+                        len(pending),
+                    )
+                    fail_pending(start)
+                    continue
+                stats.record(1, time.perf_counter() - start)
+                if len(pending) >= writer.flush_docs:
+                    commit()
+            commit()
+        except Exception:
+            LOGGER.exception("Index stage stopped")
+            fail_pending(time.perf_counter())
+        finally:
+            if not done:
+                self._drain(inp, stats)
+
+    def report(self, elapsed, queues=None):
+        queues = queues or {}
+        lines = [f"Elapsed {elapsed:.0f}s, {self.skipped} already indexed"]
+        for name, stats in self.stats.items():
+            if name == "caption" and not self.caption:
+                continue
+            lines.append(stats.report(elapsed, queues.get(name)))
+        return "\n".join(lines)
+
+    def run(self, paths):
+        names = ["geocode", "clip", "index"]
+        if self.caption:
+            names.insert(1, "caption")
+        queues = {name: queue.Queue(maxsize=self.queue_size) for name in names}
+        functions = {
+            "geocode": self.geocode,
+            "caption": self.generate_captions,
+            "clip": self.encode,
+        }
+        writer = BulkIndexer(self.es_client, self.index_name)
+        threads = [
+            threading.Thread(
+                target=self._decode_stage,
+                args=(paths, queues[names[0]]),
+                name="decode",
+            ),
+        ]
+        for name, next_name in zip(names[:-1], names[1:]):
+            threads.append(
+                threading.Thread(
+                    target=self._batch_stage,
+                    args=(name, queues[name], queues[next_name], functions[name]),
+                    name=name,
+                ),
+            )
+        threads.append(
+            threading.Thread(
+                target=self._index_stage,
+                args=(queues["index"], writer),
+                name="index",
+            ),
+        )
+
+        start = time.perf_counter()
+        with bulk_import_settings(self.es_client, self.index_name):
+            for thread in threads:
+                thread.start()
+            alive = list(threads)
+            next_report = time.monotonic() + self.report_every
+            while alive:
+                alive[0].join(timeout=max(next_report - time.monotonic(), 0))
+                alive = [thread for thread in alive if thread.is_alive()]
+                if alive and time.monotonic() >= next_report:
+                    depths = {name: q.qsize() for name, q in queues.items()}
+                    LOGGER.info(
+                        "\n%s",
+                        self.report(time.perf_counter() - start, depths),
+                    )
+                    next_report += self.report_every
+        LOGGER.info("\n%s", self.report(time.perf_counter() - start))
+        for name, stats in self.stats.items():
+            for path in stats.failed:
+                LOGGER.error("Stage %s failed on %s", name, path)
+        for failure in writer.failures:
+            LOGGER.error("Unable to index %s: %s", failure.id, failure.error)
+        return writer
+
+
+if __name__ == "__main__":
+    from pages.utils.elastic import create_index
+    from pages.utils.elastic import get_client
+    from pages.utils.metrics import start_metrics_server
+
+    parser = argparse.ArgumentParser(description="Index a directory of photos.")
+    parser.add_argument("root", help="Directory to scan recursively.")
+    parser.add_argument("--index", default="images")
+    parser.add_argument(
+        "--caption",
+        action="store_true",
+        help="Generate captions with Gemma.",
+    )
+    parser.add_argument("--language", default="spanish")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--report-every", type=float, default=10.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    start_metrics_server()
+    es_client = get_client()
+    create_index(es_client, args.index)
+    pipeline = IngestionPipeline(
+        es_client,
+        args.index,
+        caption=args.caption,
+        language=args.language,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        queue_size=args.queue_size,
+        checkpoint=Checkpoint(args.checkpoint or default_checkpoint_path(args.root)),
+        report_every=args.report_every,
+    )
+    pipeline.run(find_photos(args.root))
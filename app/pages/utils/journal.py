@@ -1,18 +1,40 @@
 from __future__ import annotations
 
+from typing import Annotated
+
+import numpy as np
+from pages.utils.serializers import unpack_vector
 from pydantic import BaseModel
+from pydantic import PlainSerializer
+from pydantic import PlainValidator
+
+
+def to_vector(value) -> np.ndarray:
+    vector = unpack_vector(value)
+    if vector.ndim != 1:
+        raise ValueError(f"Expected a one-dimensional vector, got shape {vector.shape}")
+    return vector
+
+
+# Kept as a float32 array, the Elasticsearch serializer encodes it compactly
+Vector = Annotated[
+    np.ndarray,
+    PlainValidator(to_vector),
+    PlainSerializer(lambda vector: vector.tolist(), when_used="json"),
+]
 
 
 class Image(BaseModel):
     id: str | None
     title: str
-    base64: str
-    image_vector: list[float]
+    base64: str | None = None
+    image_ref: str | None = None
+    image_vector: Vector
     city: str | None = None
     country: str | None = None
     date: str | None = None
     description: str | None = None
-    description_embedding: list[float] | None = None
+    description_embedding: Vector | None = None
     generated_description: str | None = None
-    generated_description_embedding: list[float] | None = None
+    generated_description_embedding: Vector | None = None
     tags: list[str] | None = None
@@ -0,0 +1,233 @@
+"""
+Header-only photo metadata extraction.
+
+Only the capture date and GPS position are read, without decoding any pixels.
+The `exiftool` backend drives one persistent exiftool process per worker and
+asks it for many files per call, the `pil` backend lets Pillow parse the EXIF
+header of each file. Scan a whole directory from the `app` directory with:
+
+    python -m pages.utils.metadata ~/Pictures --output metadata.jsonl
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from dataclasses import dataclass
+from pathlib import Path
+
+from pages.utils.image_exif import extract_exif_data
+from pages.utils.image_exif import gps_info_to_coordinates
+from PIL import Image
+from pillow_heif import register_heif_opener
+
+register_heif_opener()
+
+LOGGER = logging.getLogger()
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".heic")
+BACKENDS = ("auto", "exiftool", "pil")
+EXIFTOOL_TAGS = [
+    "EXIF:DateTimeOriginal",
+    "Composite:GPSLatitude",
+    "Composite:GPSLongitude",
+]
+
+
+@dataclass
+class PhotoMetadata:
+    path: str
+    date: str | None = None
+    coordinates: tuple[float, float] | None = None
+
+
+def find_photos(root):
+    for directory, _, files in sorted(os.walk(root)):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield Path(directory) / name
+
+
+def exiftool_available():
+    if shutil.which("exiftool") is None:
+        return False
+    try:
+        import exiftool  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _parse_exif_date(date):
+    if not date:
+        return None
+    try:
+        date_obj = datetime.datetime.strptime(str(date)[:19], "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
+    return date_obj.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def read_header_metadata(fp):
+    """
+    Read the capture date and GPS IFD of a single file or file object.
+
+    `Image.open` only parses the header, the pixels are never decoded.
+    """
+    with Image.open(fp) as image:
+        return extract_exif_data(image)
+
+
+def _read_pil(path):
+    try:
+        date, gps_info = read_header_metadata(path)
+    except OSError:
+        LOGGER.warning("Unable to read the metadata of %s", path)
+        return PhotoMetadata(str(path))
+    coordinates = None
+    if gps_info:
+        try:
+            coordinates = gps_info_to_coordinates(gps_info)
+        except (KeyError, TypeError, ZeroDivisionError):
+            pass
+    return PhotoMetadata(str(path), date, coordinates)
+
+
+class MetadataExtractor:
+    """
+    Extract `PhotoMetadata` for many files per call.
+
+    With the `exiftool` backend a single exiftool process is started on first
+    use and kept alive (in `-stay_open` batch mode) until `close`.
+    """
+
+    def __init__(self, backend: str = "auto"):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+        if backend == "auto":
+            backend = "exiftool" if exiftool_available() else "pil"
+        self.backend = backend
+        self._exiftool = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _helper(self):
+        if self._exiftool is None:
+            from exiftool import ExifToolHelper
+
+            self._exiftool = ExifToolHelper(common_args=["-G", "-n"])
+        return self._exiftool
+
+    def _read_exiftool(self, paths):
+        with self._lock:
+            tags = self._helper().get_tags(
+                [str(path) for path in paths],
+                tags=EXIFTOOL_TAGS,
+                params=["-fast2"],
+            )
+        metadata = []
+        for path, file_tags in zip(paths, tags):
+            latitude = file_tags.get("Composite:GPSLatitude")
+            longitude = file_tags.get("Composite:GPSLongitude")
+            coordinates = None
+            if latitude is not None and longitude is not None:
+                coordinates = (float(latitude), float(longitude))
+            metadata.append(
+                PhotoMetadata(
+                    str(path),
+                    _parse_exif_date(file_tags.get("EXIF:DateTimeOriginal")),
+                    coordinates,
+                ),
+            )
+        return metadata
+
+    def extract(self, paths) -> list[PhotoMetadata]:
+        paths = list(paths)
+        if not paths:
+            return []
+        if self.backend == "exiftool":
+            try:
+                return self._read_exiftool(paths)
+            except Exception:
+                # One unreadable file fails the whole exiftool call
+                LOGGER.warning("exiftool failed on a batch, falling back to Pillow")
+        return [_read_pil(path) for path in paths]
+
+    def close(self):
+        with self._lock:
+            if self._exiftool is not None:
+                self._exiftool.terminate()
+                self._exiftool = None
+
+
+_WORKER_EXTRACTOR: MetadataExtractor | None = None
+
+
+def _extract_chunk(paths, backend):
+    # One persistent extractor per worker process
+    global _WORKER_EXTRACTOR
+    if _WORKER_EXTRACTOR is None:
+        _WORKER_EXTRACTOR = MetadataExtractor(backend)
+    return _WORKER_EXTRACTOR.extract(paths)
+
+
+def scan_directory(root, workers=None, chunk_size: int = 64, backend: str = "auto"):
+    """
+    Extract the metadata of every photo under `root` in parallel.
+
+    The file list is split in chunks of `chunk_size` that are handed to a pool
+    of `workers` processes, each of them running its own extractor.
+    """
+    paths = [str(path) for path in find_photos(root)]
+    chunks = [paths[i : i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    metadata: list[PhotoMetadata] = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        for chunk_metadata in pool.map(_extract_chunk, chunks, [backend] * len(chunks)):
+            metadata += chunk_metadata
+    return metadata
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract the metadata of a photo directory.",
+    )
+    parser.add_argument("root")
+    parser.add_argument("--backend", choices=BACKENDS, default="auto")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=64)
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Write the metadata as JSON lines.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    metadata = scan_directory(args.root, args.workers, args.chunk_size, args.backend)
+    elapsed = time.perf_counter() - start
+    located = sum(item.coordinates is not None for item in metadata)
+    dated = sum(item.date is not None for item in metadata)
+    LOGGER.info(
+        "Scanned %s photos in %.2fs (%s dated, %s with GPS)",
+        len(metadata),
+        elapsed,
+        dated,
+        located,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            f.writelines(json.dumps(asdict(item)) + "\n" for item in metadata)
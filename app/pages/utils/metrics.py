@@ -0,0 +1,309 @@
+"""
+Lightweight in-process metrics.
+
+Stages are timed with `span` (or the `instrumented` decorator) into latency
+histograms, Elasticsearch calls additionally record the server-side `took`
+next to the wall time, and payload sizes go into a bytes histogram. The
+metrics are exported in the Prometheus text format on
+`NOSTALGIA_METRICS_PORT` (the inference server also serves them on
+`/metrics`), and every span can also be written as a JSON log line with
+`NOSTALGIA_METRICS_LOG=1`.
+"""
+
+from __future__ import annotations
+
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+LOGGER = logging.getLogger()
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+)
+BYTES_BUCKETS = tuple(1024 * 4**i for i in range(10))  # 1 KB to 256 MB
+LOG_SPANS = os.environ.get("NOSTALGIA_METRICS_LOG", "0") == "1"
+
+
+class Histogram:
+    """Cumulative histogram per label set, rendered like a Prometheus histogram."""
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # One count per bucket plus +Inf, the sum and the total count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                key: {
+                    "sum": total,
+                    "count": count,
+                    "mean": total / count if count else 0.0,
+                }
+                for key, (_, total, count) in self._series.items()
+            }
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {
+                key: (list(counts), total, count)
+                for key, (counts, total, count) in self._series.items()
+            }
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(key + (('le', le),))} {cumulative}",
+                )
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in key) + "}"
+
+
+STAGE_SECONDS = Histogram(
+    "nostalgia_stage_seconds",
+    "Wall time of each instrumented stage.",
+)
+ES_WALL_SECONDS = Histogram(
+    "nostalgia_es_wall_seconds",
+    "Client-side wall time of Elasticsearch requests and sub-queries.",
+)
+ES_TOOK_SECONDS = Histogram(
+    "nostalgia_es_took_seconds",
+    "Server-side `took` of Elasticsearch requests and sub-queries.",
+)
+PAYLOAD_BYTES = Histogram(
+    "nostalgia_payload_bytes",
+    "Size of the payloads sent to or received from each stage.",
+    buckets=BYTES_BUCKETS,
+)
+HISTOGRAMS = [STAGE_SECONDS, ES_WALL_SECONDS, ES_TOOK_SECONDS, PAYLOAD_BYTES]
+
+
+def observe_stage(stage: str, seconds: float, status: str = "ok", **labels):
+    STAGE_SECONDS.observe(seconds, stage=stage, status=status, **labels)
+    if LOG_SPANS:
+        LOGGER.info(
+            json.dumps(
+                {
+                    "event": "span",
+                    "stage": stage,
+                    "status": status,
+                    "seconds": seconds,
+                    **labels,
+                },
+            ),
+        )
+
+
+@contextmanager
+def span(stage: str, **labels):
+    """Time the block into `nostalgia_stage_seconds{stage=...}`, failures are labelled."""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start, status, **labels)
+
+
+def instrumented(stage: str):
+    """Decorator running the whole function in a `span`."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def observe_es(operation: str, wall_seconds: float | None, took_ms=None, **labels):
+    """
+    Record an Elasticsearch request, `took_ms` is the `took` of its response.
+
+    The wall time is None for the sub-responses of an `_msearch`, that only
+    have their own `took`.
+    """
+    if wall_seconds is not None:
+        ES_WALL_SECONDS.observe(wall_seconds, operation=operation, **labels)
+    if took_ms is not None:
+        ES_TOOK_SECONDS.observe(took_ms / 1000, operation=operation, **labels)
+    if LOG_SPANS:
+        LOGGER.info(
+            json.dumps(
+                {
+                    "event": "es",
+                    "operation": operation,
+                    "seconds": wall_seconds,
+                    "took_ms": took_ms,
+                    **labels,
+                },
+            ),
+        )
+
+
+def observe_response_size(operation: str, response):
+    """Record the size of an Elasticsearch response when the server sent its length."""
+    meta = getattr(response, "meta", None)
+    length = meta.headers.get("content-length") if meta is not None else None
+    if length is not None:
+        PAYLOAD_BYTES.observe(int(length), stage=f"es.{operation}", direction="in")
+
+
+def observe_payload(stage: str, nbytes: int, direction: str = "out"):
+    PAYLOAD_BYTES.observe(nbytes, stage=stage, direction=direction)
+
+
+def response_took(response):
+    body = getattr(response, "body", response)
+    return body.get("took") if isinstance(body, dict) else None
+
+
+def es_call(operation: str, fn, *args, labels: dict | None = None, **kwargs):
+    """Call an Elasticsearch client method, recording its wall time, `took` and size."""
+    start = time.perf_counter()
+    response = fn(*args, **kwargs)
+    observe_es(
+        operation,
+        time.perf_counter() - start,
+        response_took(response),
+        **(labels or {}),
+    )
+    observe_response_size(operation, response)
+    return response
+
+
+async def es_call_async(
+    operation: str,
+    fn,
+    *args,
+    labels: dict | None = None,
+    **kwargs,
+):
+    start = time.perf_counter()
+    response = await fn(*args, **kwargs)
+    observe_es(
+        operation,
+        time.perf_counter() - start,
+        response_took(response),
+        **(labels or {}),
+    )
+    observe_response_size(operation, response)
+    return response
+
+
+def render():
+    return "\n".join(histogram.render() for histogram in HISTOGRAMS) + "\n"
+
+
+def summary():
+    """Mean and count of every stage, for quick inspection in the UI."""
+    return {
+        histogram.name: {
+            ",".join(f"{name}={value}" for name, value in key): stats
+            for key, stats in histogram.snapshot().items()
+        }
+        for histogram in HISTOGRAMS
+    }
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+
+_SERVER: ThreadingHTTPServer | None = None
+_SERVER_LOCK = threading.Lock()
+
+
+def start_metrics_server(port: int | None = None, host: str = "0.0.0.0"):
+    """
+    Serve `/metrics` on a background thread, once per process.
+
+    The port defaults to `NOSTALGIA_METRICS_PORT`, nothing is started when unset.
+    """
+    global _SERVER
+    port = port or int(os.environ.get("NOSTALGIA_METRICS_PORT", 0))
+    if not port:
+        return None
+    with _SERVER_LOCK:
+        if _SERVER is None:
+            try:
+                _SERVER = ThreadingHTTPServer((host, port), MetricsHandler)
+            except OSError:
+                LOGGER.exception("Unable to serve the metrics on port %s", port)
+                return None
+            threading.Thread(
+                target=_SERVER.serve_forever,
+                name="metrics",
+                daemon=True,
+            ).start()
+            LOGGER.info("Serving metrics on http://%s:%s/metrics", host, port)
+        return _SERVER
@@ -0,0 +1,349 @@
+"""
+Process-wide registry of the loaded models.
+
+Models are loaded on first use and kept resident while they fit in the memory
+budget. When loading a model would exceed the budget, the least recently
+used models are unloaded first. Models that stay idle for longer than
+`idle_timeout` are unloaded by a background sweeper. Pinned models, like the
+CLIP encoder every search needs, are never unloaded.
+
+    registry = get_model_registry()
+    with registry.use("gemma") as (model, processor):
+        ...
+
+Models are only freed once nobody references them anymore, so hold them for
+the duration of a call (`use`) instead of storing them.
+"""
+
+from __future__ import annotations
+
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
+
+LOGGER = logging.getLogger()
+
+MB = 1024 * 1024
+# Gemma 3 4B in bf16, used to make room before it is loaded for the first time
+GEMMA_SIZE_HINT = 8600 * MB
+# Gemma 3 1B in bf16, the draft model of assisted decoding
+GEMMA_DRAFT_SIZE_HINT = 2000 * MB
+DEFAULT_IDLE_TIMEOUT = 15 * 60
+
+
+def model_nbytes(value) -> int:
+    """Bytes of the parameters and buffers of every torch module in `value`."""
+    modules = value if isinstance(value, (tuple, list)) else [value]
+    total = 0
+    for module in modules:
+        if hasattr(module, "parameters") and hasattr(module, "buffers"):
+            total += sum(p.numel() * p.element_size() for p in module.parameters())
+            total += sum(b.numel() * b.element_size() for b in module.buffers())
+    return total
+
+
+@dataclass
+class ModelEntry:
+    name: str
+    loader: Callable[[], Any]
+    pinned: bool = False
+    size_hint: int = 0
+    value: Any = None
+    nbytes: int = 0
+    last_used: float = 0.0
+    users: int = 0
+    loads: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def loaded(self):
+        return self.value is not None
+
+
+class ModelRegistry:
+    """
+    Load models on demand within a memory budget.
+
+    Args:
+        budget_bytes: Maximum bytes of resident models, 0 for no limit.
+        idle_timeout: Seconds after which an unused model is unloaded, 0 to never unload.
+        sweep_interval: Seconds between two checks for idle models.
+    """
+
+    def __init__(
+        self,
+        budget_bytes: int = 0,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        sweep_interval: float = 30.0,
+    ):
+        self.budget_bytes = budget_bytes
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self._entries: dict[str, ModelEntry] = {}
+        self._lock = threading.RLock()
+        self._sweeper: threading.Thread | None = None
+        self._preloads: dict[str, threading.Thread] = {}
+
+    def register(self, name: str, loader, pinned: bool = False, size_hint: int = 0):
+        with self._lock:
+            if name in self._entries:
+                raise ValueError(f"Model {name!r} is already registered.")
+            self._entries[name] = ModelEntry(name, loader, pinned, size_hint)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def _entry(self, name) -> ModelEntry:
+        try:
+            return self._entries[name]
+        except KeyError:
+            raise ValueError(
+                f"Unknown model {name!r}, expected one of {list(self._entries)}",
+            )
+
+    def is_loaded(self, name) -> bool:
+        return self._entry(name).loaded
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values() if entry.loaded)
+
+    def _make_room(self, needed: int, keep: str):
+        """Unload least recently used models until `needed` more bytes fit the budget."""
+        if not self.budget_bytes:
+            return
+        with self._lock:
+            candidates = sorted(
+                (
+                    entry
+                    for entry in self._entries.values()
+                    if entry.loaded
+                    and not entry.pinned
+                    and not entry.users
+                    and entry.name != keep
+                ),
+                key=lambda entry: entry.last_used,
+            )
+            for entry in candidates:
+                if self.resident_bytes() + needed <= self.budget_bytes:
+                    break
+                self._unload(entry, "over the memory budget")
+
+    def get(self, name: str):
+        """Return the model, loading it first if it isn't resident."""
+        return self._acquire(name, hold=False)
+
+    def _acquire(self, name: str, hold: bool):
+        # `last_used` and `users` change in the same locked block that reads or
+        # assigns the value, so the sweeper never unloads a model being handed out
+        entry = self._entry(name)
+        with entry.lock:
+            with self._lock:
+                value = entry.value
+                if value is not None:
+                    entry.last_used = time.monotonic()
+                    entry.users += int(hold)
+            if value is None:
+                self._make_room(entry.nbytes or entry.size_hint, keep=name)
+                start = time.perf_counter()
+                value = entry.loader()
+                with self._lock:
+                    entry.value = value
+                    entry.nbytes = model_nbytes(value)
+                    entry.loads += 1
+                    entry.last_used = time.monotonic()
+                    entry.users += int(hold)
+                LOGGER.info(
+                    "Loaded model %s (%.0f MB) in %.1fs",
+                    name,
+                    entry.nbytes / MB,
+                    time.perf_counter() - start,
+                )
+                self._make_room(0, keep=name)
+                if self.budget_bytes and self.resident_bytes() > self.budget_bytes:
+                    LOGGER.warning(
+                        "Resident models use %.0f MB, over the budget of %.0f MB",
+                        self.resident_bytes() / MB,
+                        self.budget_bytes / MB,
+                    )
+        self._start_sweeper()
+        return value
+
+    @contextmanager
+    def use(self, name: str):
+        """Hold the model for the duration of the block, it won't be unloaded meanwhile."""
+        value = self._acquire(name, hold=True)
+        entry = self._entry(name)
+        try:
+            yield value
+        finally:
+            with self._lock:
+                entry.users -= 1
+                entry.last_used = time.monotonic()
+
+    def _unload(self, entry: ModelEntry, reason: str):
+        LOGGER.info(
+            "Unloading model %s (%.0f MB), %s",
+            entry.name,
+            entry.nbytes / MB,
+            reason,
+        )
+        entry.value = None
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def unload(self, name: str) -> bool:
+        entry = self._entry(name)
+        with self._lock:
+            if not entry.loaded or entry.users:
+                return False
+            self._unload(entry, "on request")
+            return True
+
+    def unload_idle(self):
+        if not self.idle_timeout:
+            return []
+        now = time.monotonic()
+        unloaded = []
+        with self._lock:
+            for entry in self._entries.values():
+                idle = now - entry.last_used
+                if (
+                    entry.loaded
+                    and not entry.pinned
+                    and not entry.users
+                    and idle > self.idle_timeout
+                ):
+                    self._unload(entry, f"idle for {idle:.0f}s")
+                    unloaded.append(entry.name)
+        return unloaded
+
+    def _sweep(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.unload_idle()
+            except Exception:
+                LOGGER.exception("Unable to unload the idle models")
+
+    def _start_sweeper(self):
+        if not self.idle_timeout:
+            return
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(
+                    target=self._sweep,
+                    name="model-sweeper",
+                    daemon=True,
+                )
+                self._sweeper.start()
+
+    def preload(self, names):
+        """Load the models on background threads, so the first request doesn't wait for them."""
+        threads = []
+        with self._lock:
+            for name in names:
+                thread = self._preloads.get(name)
+                if thread is None:
+                    thread = threading.Thread(
+                        target=self._preload,
+                        args=(name,),
+                        name=f"preload-{name}",
+                        daemon=True,
+                    )
+                    self._preloads[name] = thread
+                    thread.start()
+                threads.append(thread)
+        return threads
+
+    def _preload(self, name):
+        try:
+            self.get(name)
+        except Exception:
+            LOGGER.exception("Unable to preload model %s", name)
+
+    def resident(self):
+        """Loaded models with their size and how long they have been idle."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "name": entry.name,
+                    "mb": round(entry.nbytes / MB, 1),
+                    "idle_seconds": round(now - entry.last_used, 1),
+                    "in_use": entry.users,
+                    "pinned": entry.pinned,
+                    "loads": entry.loads,
+                }
+                for entry in self._entries.values()
+                if entry.loaded
+            ]
+
+    def stats(self):
+        return {
+            "budget_mb": round(self.budget_bytes / MB, 1),
+            "resident_mb": round(self.resident_bytes() / MB, 1),
+            "idle_timeout": self.idle_timeout,
+            "models": self.resident(),
+        }
+
+
+def _load_clip():
+    from pages.utils.image_models import load_clip_model
+
+    return load_clip_model()
+
+
+def _load_gemma():
+    from pages.utils.image_models import load_gemma_model
+
+    return load_gemma_model()
+
+
+def _load_gemma_draft():
+    from pages.utils.image_models import load_gemma_draft_model
+
+    return load_gemma_draft_model()
+
+
+_REGISTRY: ModelRegistry | None = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_model_registry():
+    """
+    Process-wide registry with the `clip` (pinned), `gemma` and `gemma_draft` models.
+
+    The budget and idle timeout come from `NOSTALGIA_MODEL_BUDGET_MB` (0, no
+    limit, by default) and `NOSTALGIA_MODEL_IDLE_TIMEOUT` in seconds.
+    """
+    global _REGISTRY
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None:
+            _REGISTRY = ModelRegistry(
+                budget_bytes=int(os.environ.get("NOSTALGIA_MODEL_BUDGET_MB", 0)) * MB,
+                idle_timeout=float(
+                    os.environ.get(
+                        "NOSTALGIA_MODEL_IDLE_TIMEOUT",
+                        DEFAULT_IDLE_TIMEOUT,
+                    ),
+                ),
+            )
+            _REGISTRY.register("clip", _load_clip, pinned=True)
+            _REGISTRY.register("gemma", _load_gemma, size_hint=GEMMA_SIZE_HINT)
+            _REGISTRY.register(
+                "gemma_draft",
+                _load_gemma_draft,
+                size_hint=GEMMA_DRAFT_SIZE_HINT,
+            )
+        return _REGISTRY
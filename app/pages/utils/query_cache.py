@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import os
+import threading
+from collections.abc import Callable
+
+import numpy as np
+from cachetools import LRUCache
+
+DEFAULT_MAX_MB = 64
+
+
+class QueryEmbeddingCache:
+    """
+    In-process LRU cache of query embeddings.
+
+    Entries are keyed by kind, model id and query (the text itself or the hash
+    of the query image) and the cache is bounded by the bytes of the stored
+    vectors. Hit and miss counters are kept to surface its effectiveness.
+    """
+
+    def __init__(self, max_bytes: int | None = None):
+        if max_bytes is None:
+            max_mb = int(os.environ.get("NOSTALGIA_QUERY_CACHE_MB", DEFAULT_MAX_MB))
+            max_bytes = max_mb * 1024 * 1024
+        self._cache: LRUCache = LRUCache(
+            maxsize=max_bytes,
+            getsizeof=lambda v: v.nbytes,
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(
+        self,
+        key: tuple,
+        compute: Callable[[], np.ndarray],
+    ) -> np.ndarray:
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self.hits += 1
+                return vector
+            self.misses += 1
+        # Inference runs outside the lock so concurrent sessions are not serialized
+        vector = np.ascontiguousarray(compute(), dtype=np.float32).reshape(-1)
+        vector.setflags(write=False)
+        with self._lock:
+            self._cache[key] = vector
+        return vector
+
+    def text_vector(self, model_id: str, text: str, compute: Callable[[], np.ndarray]):
+        return self.get_or_compute(("text", model_id, text), compute)
+
+    def image_vector(
+        self,
+        model_id: str,
+        image_hash: str,
+        compute: Callable[[], np.ndarray],
+    ):
+        return self.get_or_compute(("image", model_id, image_hash), compute)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._cache),
+                "bytes": self._cache.currsize,
+                "max_bytes": self._cache.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
@@ -0,0 +1,93 @@
+"""
+Serializers sending the vectors of the app compactly to Elasticsearch.
+
+Vectors stay NumPy arrays from the models to the request body. They are
+written as base64 of their big-endian float32 bytes when the server accepts
+that format (Elasticsearch 9.1+), as JSON arrays otherwise. `orjson` is used
+when installed, it encodes arrays natively instead of going through Python
+floats.
+"""
+
+from __future__ import annotations
+
+import base64
+import re
+import types
+
+import numpy as np
+from elasticsearch.serializer import JsonSerializer
+from elasticsearch.serializer import NdjsonSerializer
+
+orjson: types.ModuleType | None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BASE64_VECTORS_SINCE = (9, 1)
+
+
+def pack_vector(vector) -> str:
+    """Base64 of the big-endian float32 bytes, the binary `dense_vector` format."""
+    return base64.b64encode(np.asarray(vector, dtype=">f4").tobytes()).decode("ascii")
+
+
+def unpack_vector(value) -> np.ndarray:
+    """float32 array of a vector, either packed by `pack_vector` or a list of floats."""
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype=">f4").astype(np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def supports_base64_vectors(version: str) -> bool:
+    """Whether a server of `version` (e.g. `9.1.0`) accepts base64 vectors."""
+    numbers = tuple(int(number) for number in re.findall(r"\d+", version)[:2])
+    return numbers >= BASE64_VECTORS_SINCE
+
+
+class VectorSerializerMixin(JsonSerializer):
+    # None while the server version is unknown, arrays are sent as lists meanwhile
+    base64_vectors: bool | None = None
+
+    def default(self, data):
+        if (
+            self.base64_vectors
+            and isinstance(data, np.ndarray)
+            and data.ndim == 1
+            and data.dtype.kind == "f"
+        ):
+            return pack_vector(data)
+        return super().default(data)
+
+    def json_dumps(self, data) -> bytes:
+        if orjson is None:
+            return super().json_dumps(data)
+        # Without OPT_SERIALIZE_NUMPY every array goes through `default`
+        option = 0 if self.base64_vectors else orjson.OPT_SERIALIZE_NUMPY
+        return orjson.dumps(data, default=self.default, option=option)
+
+    def json_loads(self, data: bytes):
+        if orjson is None:
+            return super().json_loads(data)
+        return orjson.loads(data)
+
+
+class VectorJsonSerializer(VectorSerializerMixin, JsonSerializer):
+    pass
+
+
+class VectorNdjsonSerializer(VectorSerializerMixin, NdjsonSerializer):
+    pass
+
+
+def get_vector_serializers():
+    """Serializers for the `serializers` argument of the clients."""
+    return {
+        VectorJsonSerializer.mimetype: VectorJsonSerializer(),
+        VectorNdjsonSerializer.mimetype: VectorNdjsonSerializer(),
+    }
+
+
+def set_base64_vectors(serializers, enabled: bool | None):
+    for serializer in serializers.values():
+        serializer.base64_vectors = enabled
@@ -0,0 +1,117 @@
+"""
+Startup helpers: lazy imports of the ML stacks and a startup-time report.
+
+`torch`, `clip` and `transformers` take seconds to import. The modules using
+them get a `LazyModule` proxy instead, so the real import only happens the
+first time an attribute is used, i.e. when a model is loaded. Check what a
+module pulls in and how long it takes to import from the `app` directory:
+
+    python -m pages.utils.startup pages.utils.elastic pages.utils.image_models
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib
+import logging
+import sys
+import threading
+import time
+import types
+
+LOGGER = logging.getLogger()
+
+HEAVY_MODULES = ("torch", "clip", "transformers")
+# Set on the first import of this module, which happens when the app starts
+STARTED_AT = time.perf_counter()
+_MILESTONES: dict[str, float] = {}
+_MILESTONES_LOCK = threading.Lock()
+
+
+class LazyModule(types.ModuleType):
+    """Module proxy that imports `name` on first attribute access."""
+
+    def __init__(self, name: str, on_import=None):
+        super().__init__(name)
+        self._lazy_on_import = on_import
+        self._lazy_module = None
+        self._lazy_lock = threading.Lock()
+
+    def _load(self):
+        with self._lazy_lock:
+            if self._lazy_module is None:
+                start = time.perf_counter()
+                module = importlib.import_module(self.__name__)
+                if self._lazy_on_import:
+                    self._lazy_on_import(module)
+                LOGGER.info(
+                    "Imported %s in %.2fs",
+                    self.__name__,
+                    time.perf_counter() - start,
+                )
+                self._lazy_module = module
+            return self._lazy_module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name: str, on_import=None) -> types.ModuleType:
+    """Return `name` if it is already imported, a proxy importing it on first use otherwise."""
+    module = sys.modules.get(name)
+    if module is not None:
+        if on_import:
+            on_import(module)
+        return module
+    return LazyModule(name, on_import)
+
+
+def loaded_heavy_modules():
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+
+def mark(name: str):
+    """
+    Record the first time the app reaches the `name` milestone.
+
+    Each milestone is logged once, with the seconds since startup and the heavy
+    modules imported by then.
+    """
+    with _MILESTONES_LOCK:
+        if name in _MILESTONES:
+            return
+        elapsed = time.perf_counter() - STARTED_AT
+        _MILESTONES[name] = elapsed
+    LOGGER.info(
+        "Startup: %s after %.2fs (ML modules loaded: %s)",
+        name,
+        elapsed,
+        ", ".join(loaded_heavy_modules()) or "none",
+    )
+
+
+def report():
+    with _MILESTONES_LOCK:
+        return {
+            "milestones": dict(_MILESTONES),
+            "heavy_modules": loaded_heavy_modules(),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the import time of modules.")
+    parser.add_argument("modules", nargs="+")
+    args = parser.parse_args()
+
+    for name in args.modules:
+        before = set(loaded_heavy_modules())
+        start = time.perf_counter()
+        importlib.import_module(name)
+        elapsed = time.perf_counter() - start
+        pulled = [module for module in loaded_heavy_modules() if module not in before]
+        print(
+            f"{name:<40}{elapsed:>8.2f}s  ML modules imported: {', '.join(pulled) or 'none'}",
+        )